@@ -1,32 +1,48 @@
 # Demonstrates Bootstrap version 3.3 Starter Template
 # available here: https://getbootstrap.com/docs/3.3/getting-started/#examples
 
-from flask import Flask, request, render_template
+from flask import Flask, Response, request, jsonify, abort
+import flask
 from flask_basicauth import BasicAuth
 import pandas as pd
 import numpy as np
 import psycopg2 as pg2
 import pandas.io.sql as sqlio
+import os
 import sys
 sys.path.append("..")
+from src.db import configure_pool
 from src.get_clusters import get_table
-from src.category_recommender import sold_by_store, top_sold_by_cluster, top_sold_overall, compare_products
-from src.price_optimizer import prod_subset
+from src.batch_recommender import get_recommendation
+from src.lookup import lookup_page, LOOKUPS
+from src.serving import CONFIG, PRODUCT_SQL, Serving, request_month, lookup_args, recommendation_args, \
+    batch_args, end_request
+from src import metrics
+from src.metrics import timed
 
 app = Flask(__name__)
-
-app.config['BASIC_AUTH_USERNAME'] = 'impulsify'
-app.config['BASIC_AUTH_PASSWORD'] = 'superhighsecurity'
-app.config['BASIC_AUTH_FORCE'] = True
+app.config.update(CONFIG) # defaults shared with async_app.py, see src/serving.py
 basic_auth = BasicAuth(app)
 
-#sold = get_table('SELECT * FROM product_category_recommender')
-sql = 'SELECT DISTINCT property_code FROM product_category_recommender ORDER BY property_code'
-prop_list = list(get_table(sql).iloc[:,0])
-sql = 'SELECT DISTINCT transaction_month FROM product_category_recommender ORDER BY transaction_month DESC'
-month_list = list(get_table(sql).iloc[:,0])
-sql = 'SELECT DISTINCT category_name FROM product_category_recommender ORDER BY category_name'
-category_list = list(get_table(sql).iloc[:,0])
+# every get_table call below (and in src/) checks a connection out of this shared pool
+configure_pool(maxconn=app.config['DB_POOL_SIZE'])
+
+serving = Serving(app.config, app.root_path)
+dimensions = serving.dimensions
+
+def render_template(*args, **kwargs):
+    with timed('render_template'):
+        return flask.render_template(*args, **kwargs)
+
+@app.before_request
+def start_timer():
+    # every stage timed while serving this request is labeled with its route
+    metrics.start_request(request.endpoint)
+
+@app.after_request
+def stop_timer(response):
+    end_request(app.logger, request.path, app.config['SLOW_REQUEST_SECONDS'])
+    return response
 
 # home page
 @app.route('/')
@@ -36,8 +52,8 @@ def index():
 @app.route('/product_recommender', methods=['GET', 'POST'])
 def product_recommender():
     
-    categories = category_list
-    months = month_list
+    categories = dimensions.get('categories')
+    months = dimensions.get('months')
     nums = [5, 1, 2, 3, 4, 6, 7, 8, 9, 10]
     return render_template('product_recommender.html', categories = categories, months = months, nums = nums)
 
@@ -45,102 +61,95 @@ def product_recommender():
 def product_recommender_results():
     property = request.form['property'] 
     category = request.form['category']
-    month = request.form['month']
+    month = request_month(request.form)
     num = request.form['num']
-    
-    SQL = """SELECT * 
-            FROM product_category_recommender 
-            WHERE transaction_month = '{0}'
-            """.format(month)
-    sold = get_table(SQL)
 
-    recommendation = compare_products(property, category, month, int(num), sold)
+    peers = serving.similar_hotels(property)
+    recommendation = None
+    if app.config['USE_PRECOMPUTED_RECOMMENDATIONS'] and not isinstance(month, tuple):
+        recommendation = get_recommendation(property, category, month, int(num))
+        if recommendation is not None:
+            recommendation = serving.with_peers(recommendation, peers, category, month, int(num))
+
+    if recommendation is None:
+        recommendation = serving.compare(property, category, month, int(num), peers)
 
     return render_template('product_recommender_results.html', property=property, recommendation=recommendation)
 
 @app.route('/property_lookup', methods=['GET', 'POST'])
 def property_lookup():
-    sql = 'SELECT DISTINCT flag_name FROM product_category_recommender ORDER BY flag_name'
-    flags = []
-    flags.append(None)
-    flags = flags + list(get_table(sql).iloc[:,0])
-    sql = 'SELECT DISTINCT city FROM product_category_recommender ORDER BY city'
-    cities = list(get_table(sql).iloc[:,0])
-    sql = 'SELECT DISTINCT state FROM product_category_recommender ORDER BY state'
-    states = [None] + list(get_table(sql).iloc[:,0])
-
-    city = None
-    state = None
-
-    if request.method == 'POST':
-        city = request.form['city']
-        prop_lookup = get_table("SELECT * FROM property_code_lookup WHERE city = '{}' ".format(city))
-    #     if request.form['city']:
-    #         city = request.form['city']
-    #     state = request.form['state']
-    #     flag_name = request.form['flag_name']
-    # if city != None:
-    #     prop_lookup = get_table("SELECT * FROM property_code_lookup WHERE city = '{}' ".format(city))
-    # if state != None:
-    #     prop_lookup = get_table("SELECT * FROM property_code_lookup WHERE state = '{}' ".format(state))
-    # if flag_name != None:
-    #     prop_lookup = get_table("SELECT * FROM property_code_lookup WHERE flag_name = '{}' ".format(flag_name))
-    else:
-        prop_lookup = get_table('SELECT * FROM property_code_lookup')
-    return render_template('property_lookup.html', data = prop_lookup.to_html(), \
-        flags = flags, cities = cities, states = states)
+    flags = [None] + dimensions.get('flags')
+    cities = [None] + dimensions.get('cities')
+    states = [None] + dimensions.get('states')
+
+    filters, sort, descending, page = lookup_args(request.values, ['flag_name', 'city', 'state'])
+    try:
+        prop_lookup, has_next = lookup_page('property_code_lookup', filters, sort, descending, page)
+    except ValueError:
+        abort(400)
+    with timed('to_html'):
+        data = prop_lookup.to_html(index=False)
+    return render_template('property_lookup.html', data = data, \
+        flags = flags, cities = cities, states = states, filters = filters, sort = sort, \
+        desc = descending, page = page, has_next = has_next, sort_cols = LOOKUPS['property_code_lookup'][0])
 
 @app.route('/price_optimizer', methods=['GET', 'POST'])
 def price_optimizer():
-    #sql = 'SELECT DISTINCT description FROM product_category_recommender ORDER BY description'
-    descriptions = []#list(get_table(sql).iloc[:,0])
-    
-    product_description = None
-    sold = None
-    best_price = None
-    best_sales = None
-    best_rev = None
-    chart1 = None
-    chart2 = None
-
+    page = serving.price_optimizer_page()
     if request.method == 'POST':
         product_description = request.form['product_description']
-        sql = "SELECT * FROM product_category_recommender WHERE description = '{}' ".format(product_description) 
-        sold = get_table(sql)
-        sold['unit_price'] = np.round(sold.dollars_sold / sold.number_sold, 2)
-        prod = prod_subset(sold, product_description)
-        print('description = {}'.format(prod.description))
-        prod.dists()    
-        prod.boxplots()
-        best_price = '{0:.2f}'.format(prod.best_price_)
-        best_sales = '{0:.0f}'.format(prod.best_sales_)
-        best_rev = '{0:.0f}'.format(prod.best_rev_)
-        chart1 = 'static/sales_boxplot.png'
-        chart2 = 'static/sales_distributions.png'
-        
-        
-    return render_template('price_optimizer.html', descriptions = descriptions, product_description = product_description, \
-         sold = sold, best_price = best_price, best_rev = best_rev, best_sales = best_sales, chart1 = chart1, chart2 = chart2)
+        raw = get_table(PRODUCT_SQL, params={'description': product_description})
+        page = serving.price_optimizer_page(product_description, raw, request.form.get('what_if_price'))
+    return render_template('price_optimizer.html', **page)
 
 @app.route('/product_lookup', methods=['GET', 'POST'])
 def product_lookup():
-    category = None
-    sql = '''SELECT *
-                FROM product_category_xref 
-                ORDER BY category_name, description
-                '''
-    if request.method == 'POST':
-        category = request.form['category']
-        sql = '''SELECT * 
-                    FROM product_category_xref
-                    WHERE category_name = '{}'
-                    ORDER BY category_name, description
-                    '''.format(category)
-        
-    products = get_table(sql)
-    categories = list(get_table('SELECT name FROM categories ORDER BY name').iloc[:,0])
-
-    return render_template('product_lookup.html', data = products.to_html(), categories = categories)
+    categories = [None] + dimensions.get('categories')
+
+    filters, sort, descending, page = lookup_args(request.values, ['category_name'])
+    # the category form posts 'category'
+    filters['category_name'] = filters['category_name'] or request.values.get('category') or None
+    try:
+        products, has_next = lookup_page('product_category_xref', filters, sort, descending, page)
+    except ValueError:
+        abort(400)
+    with timed('to_html'):
+        data = products.to_html(index=False)
+    return render_template('product_lookup.html', data = data, categories = categories, \
+        filters = filters, sort = sort, desc = descending, page = page, has_next = has_next, \
+        sort_cols = LOOKUPS['product_category_xref'][0])
+
+@app.route('/api/recommendations')
+def api_recommendations():
+    try:
+        property_code, category, month, num, k = recommendation_args(request.args)
+    except KeyError as e:
+        return jsonify(error='missing parameter {}'.format(e.args[0])), 400
+    result = serving.api_recommendation(property_code, category, month, num, k)
+    if result is None:
+        return jsonify(error='unknown property_code'), 404
+    return jsonify(result)
+
+@app.route('/api/recommendations/batch', methods=['POST'])
+def api_recommendations_batch():
+    '''
+    body: {"month": "2019-09", "num": 5, "items": [{"property": ..., "category": ...}, ...]}
+    every item is answered from one aggregation of the month
+    '''
+    try:
+        month, num, pairs = batch_args(request.get_json(force=True, silent=True) or {},
+                                       app.config['API_BATCH_LIMIT'])
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    return jsonify(month=month, num=num, results=serving.recommend_many(pairs, month, num))
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache_stats')
+def cache_stats():
+    return jsonify(serving.month_cache.stats())
 
 @app.route('/about')
 def about():
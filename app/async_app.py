@@ -0,0 +1,192 @@
+# ASGI version of app.py: the same pages and API served by Quart with an asyncpg pool.
+# Queries are awaited on the event loop, pandas / matplotlib work runs in a thread pool,
+# so one slow month query doesn't hold up everyone else. Run with e.g.
+#   hypercorn async_app:app --bind 0.0.0.0:8080
+
+from quart import Quart, Response, request, jsonify, abort
+import quart
+import asyncpg
+import asyncio
+import hmac
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+import sys
+sys.path.append("..")
+from src.async_db import AsyncDatabase
+from src.batch_recommender import recommendation_sql, recommendation_lines
+from src.lookup import lookup_sql, split_page, LOOKUPS
+from src.serving import CONFIG, PRODUCT_SQL, Serving, request_month, lookup_args, recommendation_args, \
+    batch_args, end_request
+from src import metrics
+from src.metrics import timed
+
+app = Quart(__name__)
+app.config.update(CONFIG) # defaults shared with app.py, see src/serving.py
+
+db = AsyncDatabase(max_size=app.config['DB_POOL_SIZE'])
+executor = ThreadPoolExecutor(app.config['EXECUTOR_THREADS'])
+
+# everything in serving reads through db.blocking, which must only be called from
+# executor threads (see run_sync), never from the event loop itself
+serving = Serving(app.config, app.root_path, read=db.blocking)
+dimensions = serving.dimensions
+
+async def run_sync(func, *args, **kwargs):
+    '''
+    runs blocking work in the executor, in a copy of the request's context so its stages
+    are still timed under the request's route
+    '''
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, lambda: ctx.run(func, *args, **kwargs))
+
+async def render_template(*args, **kwargs):
+    with timed('render_template'):
+        return await quart.render_template(*args, **kwargs)
+
+@app.before_serving
+async def startup():
+    await db.connect()
+
+@app.after_serving
+async def shutdown():
+    await db.close()
+    executor.shutdown(wait=False)
+
+def _same_secret(given, expected):
+    return hmac.compare_digest((given or '').encode('utf-8'), expected.encode('utf-8'))
+
+@app.before_request
+async def check_auth():
+    if not app.config['BASIC_AUTH_FORCE']:
+        return
+    auth = request.authorization
+    # compare_digest takes as long whichever character differs, so timing doesn't leak the password
+    if auth is None or not (_same_secret(auth.username, app.config['BASIC_AUTH_USERNAME']) &
+                            _same_secret(auth.password, app.config['BASIC_AUTH_PASSWORD'])):
+        return Response('Login required', 401, {'WWW-Authenticate': 'Basic realm=""'})
+
+@app.before_request
+async def start_timer():
+    metrics.start_request(request.endpoint)
+
+@app.after_request
+async def stop_timer(response):
+    end_request(app.logger, request.path, app.config['SLOW_REQUEST_SECONDS'])
+    return response
+
+async def precomputed_recommendation(property_code, category, month, num):
+    sql, params = recommendation_sql(property_code, category, month, num)
+    try:
+        return recommendation_lines(await db.get_table(sql, params))
+    except asyncpg.UndefinedTableError: # batch job has never been run
+        return None
+
+# home page
+@app.route('/')
+async def index():
+    return await render_template('index.html')
+
+@app.route('/product_recommender', methods=['GET', 'POST'])
+async def product_recommender():
+    categories = await run_sync(dimensions.get, 'categories')
+    months = await run_sync(dimensions.get, 'months')
+    nums = [5, 1, 2, 3, 4, 6, 7, 8, 9, 10]
+    return await render_template('product_recommender.html', categories = categories, months = months, nums = nums)
+
+@app.route('/product_recommender_results', methods=['GET', 'POST'])
+async def product_recommender_results():
+    form = await request.form
+    property = form['property']
+    category = form['category']
+    month = request_month(form)
+    num = int(form['num'])
+
+    peers = await run_sync(serving.similar_hotels, property)
+    recommendation = None
+    if app.config['USE_PRECOMPUTED_RECOMMENDATIONS'] and not isinstance(month, tuple):
+        recommendation = await precomputed_recommendation(property, category, month, num)
+        if recommendation is not None:
+            recommendation = await run_sync(serving.with_peers, recommendation, peers, category, month, num)
+
+    if recommendation is None:
+        recommendation = await run_sync(serving.compare, property, category, month, num, peers)
+
+    return await render_template('product_recommender_results.html', property=property, recommendation=recommendation)
+
+async def lookup(table, filters, sort, descending, page):
+    try:
+        sql, params = lookup_sql(table, filters, sort, descending, page)
+    except ValueError:
+        abort(400)
+    rows, has_next = split_page(await db.get_table(sql, params))
+    with timed('to_html'):
+        return rows.to_html(index=False), has_next
+
+@app.route('/property_lookup', methods=['GET', 'POST'])
+async def property_lookup():
+    flags, cities, states = await run_sync(lambda: ([None] + dimensions.get('flags'),
+                                                    [None] + dimensions.get('cities'),
+                                                    [None] + dimensions.get('states')))
+    filters, sort, descending, page = lookup_args(await request.values, ['flag_name', 'city', 'state'])
+    data, has_next = await lookup('property_code_lookup', filters, sort, descending, page)
+    return await render_template('property_lookup.html', data = data, \
+        flags = flags, cities = cities, states = states, filters = filters, sort = sort, \
+        desc = descending, page = page, has_next = has_next, sort_cols = LOOKUPS['property_code_lookup'][0])
+
+@app.route('/product_lookup', methods=['GET', 'POST'])
+async def product_lookup():
+    categories = [None] + await run_sync(dimensions.get, 'categories')
+    values = await request.values
+    filters, sort, descending, page = lookup_args(values, ['category_name'])
+    # the category form posts 'category'
+    filters['category_name'] = filters['category_name'] or values.get('category') or None
+    data, has_next = await lookup('product_category_xref', filters, sort, descending, page)
+    return await render_template('product_lookup.html', data = data, categories = categories, \
+        filters = filters, sort = sort, desc = descending, page = page, has_next = has_next, \
+        sort_cols = LOOKUPS['product_category_xref'][0])
+
+@app.route('/price_optimizer', methods=['GET', 'POST'])
+async def price_optimizer():
+    page = serving.price_optimizer_page()
+    if request.method == 'POST':
+        form = await request.form
+        product_description = form['product_description']
+        raw = await db.get_table(PRODUCT_SQL, {'description': product_description})
+        page = await run_sync(serving.price_optimizer_page, product_description, raw, form.get('what_if_price'))
+    return await render_template('price_optimizer.html', **page)
+
+@app.route('/api/recommendations')
+async def api_recommendations():
+    try:
+        property_code, category, month, num, k = recommendation_args(request.args)
+    except KeyError as e:
+        return jsonify(error='missing parameter {}'.format(e.args[0])), 400
+    result = await run_sync(serving.api_recommendation, property_code, category, month, num, k)
+    if result is None:
+        return jsonify(error='unknown property_code'), 404
+    return jsonify(result)
+
+@app.route('/api/recommendations/batch', methods=['POST'])
+async def api_recommendations_batch():
+    try:
+        month, num, pairs = batch_args(await request.get_json(force=True, silent=True) or {},
+                                       app.config['API_BATCH_LIMIT'])
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    results = await run_sync(serving.recommend_many, pairs, month, num)
+    return jsonify(month=month, num=num, results=results)
+
+@app.route('/metrics')
+async def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/cache_stats')
+async def cache_stats():
+    return jsonify(serving.month_cache.stats())
+
+@app.route('/about')
+async def about():
+    return await render_template('about.html')
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=8080)
@@ -0,0 +1,87 @@
+import re
+import asyncio
+import pandas as pd
+import asyncpg
+
+_PARAM = re.compile(r'%\((\w+)\)s')
+
+
+def to_dollar_params(sql, params = None):
+    '''
+    rewrites psycopg2 style %(name)s parameters as asyncpg's $1, $2, ...
+
+    outputs:
+        (SQL, list of arguments in $n order); a name used twice binds the same $n
+    '''
+    params = params or {}
+    order = []
+
+    def number(match):
+        name = match.group(1)
+        if name not in order:
+            order.append(name)
+        return '${}'.format(order.index(name) + 1)
+
+    sql = _PARAM.sub(number, sql).replace('%%', '%')
+    return sql, [params[name] for name in order]
+
+
+class AsyncDatabase(object):
+    '''
+    asyncpg connection pool with the get_table / execute_sql interface of src/get_clusters.py
+
+    Inputs:
+        db, user, host, port = same connection settings as get_table
+        min_size, max_size = pool size; a request waits for a free connection when
+            max_size queries are already running
+
+    Queries keep the %(name)s parameters used everywhere else in the repo. NUMERIC
+    columns (dollars_sold, ...) are decoded as floats rather than Decimal, as
+    read_sql_query(coerce_float=True) does for get_table.
+
+    Methods:
+        connect() / close() : open and close the pool (awaitable)
+        get_table(sql, params) : DataFrame of the result (awaitable)
+        execute_sql(sql, params) : runs a statement that returns no rows (awaitable)
+        blocking(sql, params) : get_table for code running in an executor thread, so
+            sync functions that take a read function (SqlSales, Dimensions, ...) can
+            share the pool
+    '''
+
+    def __init__(self, db = 'xxx', user = 'postgres', host = 'localhost', port = '0000',
+                 min_size = 1, max_size = 10):
+        self.dsn = dict(database=db, user=user, host=host, port=port)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self.loop = None
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self.pool = await asyncpg.create_pool(min_size=self.min_size, max_size=self.max_size,
+                                              init=self._init_connection, **self.dsn)
+
+    @staticmethod
+    async def _init_connection(conn):
+        await conn.set_type_codec('numeric', encoder=str, decoder=float, schema='pg_catalog', format='text')
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def get_table(self, sql, params = None):
+        sql, args = to_dollar_params(sql, params)
+        async with self.pool.acquire() as conn:
+            stmt = await conn.prepare(sql)
+            rows = await stmt.fetch(*args)
+            columns = [attr.name for attr in stmt.get_attributes()]
+        return pd.DataFrame([tuple(row) for row in rows], columns=columns)
+
+    async def execute_sql(self, sql, params = None):
+        sql, args = to_dollar_params(sql, params)
+        async with self.pool.acquire() as conn:
+            await conn.execute(sql, *args)
+
+    def blocking(self, sql, params = None):
+        return asyncio.run_coroutine_threadsafe(self.get_table(sql, params), self.loop).result()
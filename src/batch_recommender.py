@@ -0,0 +1,144 @@
+import pandas as pd
+import numpy as np
+import argparse
+import multiprocessing as mp
+import sys
+sys.path.append("..")
+from src.get_clusters import get_table, push_table
+from src.db import connection
+from src.pg_copy import copy_dataframe
+from src.sales_cube import SalesCube
+from src.category_recommender import compare_products
+from src.encoding import load_sales
+
+RECOMMENDATION_TABLE = 'product_recommendations'
+STALE_TABLE = 'stale_recommendations' # marked by src/incremental.py, a NULL property_code means every property
+STALE_TABLE_SQL = '''CREATE TABLE IF NOT EXISTS {} (transaction_month TEXT, category_name TEXT,
+                        property_code TEXT, marked_at TIMESTAMP DEFAULT now())'''.format(STALE_TABLE)
+RECOMMENDATION_COLS = ['property_code', 'category_name', 'transaction_month', 'num',
+                       'line_no', 'level', 'text']
+
+_cube = None  # set in each worker by _init_worker
+
+
+def _init_worker(cube):
+    global _cube
+    _cube = cube
+
+def _recommend_chunk(args):
+    '''
+    runs compare_products for every (property, category) pair in one chunk of properties
+    '''
+    property_codes, categories, month, num = args
+    rows = []
+    for property_code in property_codes:
+        for category in categories:
+            lines = compare_products(property_code, category, month, num, _cube)
+            for line_no, (level, text) in enumerate(lines):
+                rows.append((property_code, category, month, num, line_no, level, text))
+    return rows
+
+def recommend_month(sold, month, num = 5, processes = None):
+    '''
+    inputs:
+        sold = sales DataFrame containing (at least) the month to score
+        month = transaction_month
+        num = number of products to compare
+        processes = worker processes to use (defaults to every core)
+
+    outputs:
+        DataFrame of RECOMMENDATION_COLS, one row per line of compare_products output,
+        for every property that sold anything in that month and every category
+    '''
+    sold = sold[sold.transaction_month == month]
+    cube = SalesCube(sold)
+    property_codes = sorted(sold.property_code.unique())
+    categories = sorted(sold.category_name.unique())
+
+    processes = processes or mp.cpu_count()
+    chunks = np.array_split(property_codes, processes * 4)
+    tasks = [(list(chunk), categories, month, num) for chunk in chunks if len(chunk) > 0]
+
+    # the cube is pickled to each worker once, not once per task
+    with mp.Pool(processes, initializer=_init_worker, initargs=(cube,)) as pool:
+        results = pool.map(_recommend_chunk, tasks)
+
+    return pd.DataFrame([row for rows in results for row in rows], columns=RECOMMENDATION_COLS)
+
+def push_recommendations(recs, month, table = RECOMMENDATION_TABLE):
+    '''
+    replaces the rows for month in the recommendation table, clears the month's stale
+    marks and makes sure the lookup index used by the web app exists. The delete and the
+    load run in one transaction, so a failed load leaves the month's old rows in place
+    '''
+    push_table(recs.head(0), table, if_exists='append') # creates the table on first run
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(STALE_TABLE_SQL)
+        cur.execute('DELETE FROM {} WHERE transaction_month = %(month)s'.format(table), {'month': month})
+        copy_dataframe(cur, recs, table)
+        cur.execute('DELETE FROM {} WHERE transaction_month = %(month)s'.format(STALE_TABLE), {'month': month})
+        cur.execute('''CREATE INDEX IF NOT EXISTS {0}_lookup
+                        ON {0} (transaction_month, property_code, category_name, num)'''.format(table))
+
+def recommendation_sql(property_code, category, month, num, table = RECOMMENDATION_TABLE):
+    '''
+    (SQL, bind parameters) reading the precomputed lines of one recommendation
+    '''
+    sql = '''SELECT level, text
+                FROM {}
+                WHERE transaction_month = %(month)s
+                    AND property_code = %(property_code)s
+                    AND category_name = %(category)s
+                    AND num = %(num)s
+                    AND NOT EXISTS (SELECT 1 FROM {}
+                                    WHERE transaction_month = %(month)s
+                                        AND category_name = %(category)s
+                                        AND (property_code = %(property_code)s OR property_code IS NULL))
+                ORDER BY line_no'''.format(table, STALE_TABLE)
+    params = {'month': month, 'property_code': property_code, 'category': category, 'num': num}
+    return sql, params
+
+def recommendation_lines(recs):
+    '''
+    rows read by recommendation_sql as (level, text) tuples, None if there weren't any
+    (never scored, or marked stale since)
+    '''
+    if recs.shape[0] == 0:
+        return None
+    return list(zip(recs.level, recs.text))
+
+def get_recommendation(property_code, category, month, num, table = RECOMMENDATION_TABLE):
+    '''
+    returns the precomputed compare_products output as a list of (level, text) tuples,
+    or None if the batch job hasn't scored this combination
+    '''
+    sql, params = recommendation_sql(property_code, category, month, num, table)
+    try:
+        recs = get_table(sql, params=params)
+    except pd.io.sql.DatabaseError: # batch job has never been run
+        return None
+    return recommendation_lines(recs)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='precompute product recommendations for a month')
+    parser.add_argument('month', nargs='?', help='transaction_month to score (defaults to the latest)')
+    parser.add_argument('--num', type=int, default=5, help='number of products to compare')
+    parser.add_argument('--processes', type=int, default=None, help='worker processes (defaults to every core)')
+    args = parser.parse_args()
+
+    month = args.month
+    if month is None:
+        month = get_table('SELECT MAX(transaction_month) FROM product_category_recommender').iloc[0, 0]
+
+    print('getting data for {}...'.format(month))
+    sold = load_sales('SELECT * FROM product_category_recommender WHERE transaction_month = %(month)s',
+                      params={'month': month})
+
+    print('scoring...')
+    recs = recommend_month(sold, month, args.num, args.processes)
+
+    print('writing {} rows to db...'.format(recs.shape[0]))
+    push_recommendations(recs, month)
+    print('complete.')
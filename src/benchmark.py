@@ -0,0 +1,99 @@
+import time
+import tracemalloc
+import argparse
+import pandas as pd
+import numpy as np
+import sys
+sys.path.append("..")
+from src.synthetic import generate_properties, generate_sales
+from src.encoding import encode_sales
+from src.sales_cube import SalesCube
+from src.category_recommender import compare_products
+from src.price_optimizer import prod_subset, optimize_prices
+from src.get_clusters import prepare_properties
+from src.features import PropertyFeatures
+from src.clustering import fit_clusters
+
+
+def _measure(stage, items, func):
+    '''
+    runs func once, returning seconds, peak traced memory and items per second
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'stage': stage, 'items': items, 'seconds': seconds,
+            'items_per_sec': items / seconds if seconds > 0 else np.nan,
+            'peak_mb': peak / 1024**2}
+
+def run_benchmark(n_properties, n_months = 24, n_categories = 20, stocked_per_category = 8,
+                  queries = 200, products = 50, cluster_method = 'birch', seed = 0):
+    '''
+    inputs:
+        n_properties, n_months, n_categories, stocked_per_category = synthetic data size
+        queries = compare_products calls timed against one month
+        products = prod_subset instances timed
+        cluster_method = fit_clusters backend for the clustering stage
+
+    outputs:
+        DataFrame with seconds, throughput and peak memory of every stage
+    '''
+    rng = np.random.RandomState(seed)
+    props = generate_properties(n_properties, seed=seed)
+    sold = encode_sales(generate_sales(props, n_months, n_categories,
+                                       stocked_per_category=stocked_per_category, seed=seed))
+    sold['unit_price'] = np.round(sold.dollars_sold / sold.number_sold, 2)
+    month = sold.transaction_month.astype(str).max()
+    month_sold = sold[sold.transaction_month == month]
+    results = []
+
+    cube = {}
+    def build_cube():
+        cube['cube'] = SalesCube(month_sold)
+    results.append(_measure('sales_cube_build', month_sold.shape[0], build_cube))
+
+    property_codes = rng.choice(props.property_code.values, queries)
+    categories = rng.choice(sold.category_name.cat.categories, queries)
+    def recommend():
+        for property_code, category in zip(property_codes, categories):
+            compare_products(property_code, category, month, 5, cube['cube'])
+    results.append(_measure('compare_products', queries, recommend))
+
+    descriptions = rng.choice(sold.description.cat.categories, products)
+    def optimize_one_at_a_time():
+        for description in descriptions:
+            prod_subset(sold, description)
+    results.append(_measure('prod_subset', products, optimize_one_at_a_time))
+
+    results.append(_measure('optimize_prices', sold.description.nunique(),
+                            lambda: optimize_prices(sold)))
+
+    def cluster():
+        prepared = prepare_properties(props)
+        fit_clusters(PropertyFeatures().fit_transform(prepared), cluster_method)
+    results.append(_measure('clustering_' + cluster_method, n_properties, cluster))
+
+    out = pd.DataFrame(results)
+    out.insert(0, 'sales_rows', sold.shape[0])
+    out.insert(0, 'properties', n_properties)
+    return out
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='time the recommender, price optimizer and clustering on synthetic data')
+    parser.add_argument('--properties', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--months', type=int, default=24)
+    parser.add_argument('--categories', type=int, default=20)
+    parser.add_argument('--stocked', type=int, default=8, help='products stocked per category per property')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--products', type=int, default=50)
+    parser.add_argument('--cluster-method', default='birch')
+    args = parser.parse_args()
+
+    for n in args.properties:
+        print(run_benchmark(n, args.months, args.categories, args.stocked, args.queries,
+                            args.products, args.cluster_method).to_string(index=False))
+        print('')
@@ -5,159 +5,303 @@ import pandas.io.sql as sqlio
 import sys
 sys.path.append("..")
 from src.get_clusters import get_table
+from src.sales_cube import SalesCube
+from src.snapshot import SalesSnapshot
+from src.range_cube import month_label
+from src.metrics import timed
 
 
+def as_sales_source(df):
+    '''
+    wraps raw sales data in a SalesCube so repeated lookups don't redo the groupbys.
+    Anything that already answers the lookups (e.g. a prebuilt SalesCube) is returned as is
+    '''
+    if isinstance(df, pd.DataFrame):
+        return SalesCube(df)
+    return df
+
+@timed('sold_by_store')
 def sold_by_store(property_code, category, month, df):
-    top_store = df[['cluster','property_code','category_name','description', 'transaction_month', 'number_sold']][df.number_sold > 0]. \
-        groupby(['cluster','property_code','category_name', 'description', 'transaction_month'], as_index=False).sum(). \
-        sort_values(by=['property_code','category_name', 'transaction_month', 'number_sold'], ascending=False)    
-    
-    out = top_store[(top_store.property_code == property_code) & 
-                    (top_store.category_name == category) & 
-                    (top_store.transaction_month == month)]
-    total_sold = np.sum(out.number_sold)
-    out.loc[:, 'pct_of_sold'] = out['number_sold']/total_sold
-    out.loc[:,'cum_pct'] = out['pct_of_sold'].cumsum()
-    
-    return out
+    return as_sales_source(df).sold_by_store(property_code, category, month)
 
+@timed('top_sold_by_cluster')
 def top_sold_by_cluster(cluster, category, month, num, df):
-    top_cluster = df[['cluster', 'category_name','description', 'transaction_month','number_sold']][df.number_sold > 0]. \
-        groupby(['cluster','category_name', 'description', 'transaction_month'], as_index=False).sum(). \
-        sort_values(by=['cluster','category_name', 'transaction_month', 'number_sold'], ascending=False)
-
-    return top_cluster[(top_cluster.cluster == cluster) & 
-                       (top_cluster.category_name == category) & 
-                       (top_cluster.transaction_month == month)].head(num)
+    return as_sales_source(df).top_sold_by_cluster(cluster, category, month, num)
 
+@timed('top_sold_overall')
 def top_sold_overall(category, month, num, df):
-    top_overall = df[['category_name', 'description', 'transaction_month','number_sold']][df.number_sold > 0]. \
-        groupby(['category_name', 'description', 'transaction_month'], as_index=False).sum(). \
-        sort_values(by=['category_name', 'transaction_month', 'number_sold'], ascending=False)
-    
-    return top_overall[(top_overall.category_name == category) & 
-                       (top_overall.transaction_month == month)].head(num)
+    return as_sales_source(df).top_sold_overall(category, month, num)
+
+@timed('top_sold_by_peers')
+def top_sold_by_peers(peers, category, month, num, df):
+    '''
+    inputs: peers = property_codes to pool, e.g. from src/peer_index.py
+            category, month, num, df = as top_sold_by_cluster
+    outputs: top num products by number_sold summed over the peers' own store slices,
+            so the cost follows the number of peers, not the size of the fleet. Sources
+            with a top_sold_by_properties method answer it in one lookup instead
+    '''
+    df = as_sales_source(df)
+    if len(peers) == 0:
+        return pd.DataFrame({'description': [], 'number_sold': []})
+    if hasattr(df, 'top_sold_by_properties'): # e.g. SqlSales: one query for every peer
+        return df.top_sold_by_properties(peers, category, month, num)
+    sold = [df.sold_by_store(p, category, month)[['description', 'number_sold']] for p in peers]
+    sold = [s for s in sold if s.shape[0] > 0]
+    if not sold:
+        return pd.DataFrame({'description': [], 'number_sold': []})
+    sold = pd.concat(sold, ignore_index=True)
+    sold['description'] = sold.description.astype(str)
+    sold = sold.groupby('description', as_index=False).number_sold.sum()
+    # best sellers first, ties broken by description, same as SalesCube
+    order = np.lexsort((sold.description.values, -sold.number_sold.values))
+    return sold.iloc[order[:num]].reset_index(drop=True)
+
+def known_property(property_code, df):
+    '''
+    whether df has sales, and so a cluster, for property_code
+    '''
+    return not pd.isnull(as_sales_source(df).cluster_of(property_code))
+
+def _value(x):
+    '''
+    numpy scalars as plain python values and missing values as None, so results serialize to JSON
+    '''
+    if pd.isnull(x):
+        return None
+    return x.item() if hasattr(x, 'item') else x
+
+def _ranked(prods, num, total = None):
+    '''
+    top num rows of a ranked slice as dicts. share is of total when given, otherwise
+    the slice's own pct_of_sold
+    '''
+    prods = prods.head(num)
+    shares = prods.number_sold / total if total is not None else prods.pct_of_sold
+    return [{'rank': i + 1, 'description': _value(d), 'number_sold': _value(n), 'share': _value(sh)}
+            for i, (d, n, sh) in enumerate(zip(prods.description, prods.number_sold, shares))]
+
+@timed('recommend')
+def recommend(property_code, category, month, num, df, peers = None):
+    '''
+    inputs: same as compare_products
+    outputs: dict with the store's, its cluster's and the national top products (share is
+            the fraction of units sold), the products to add (top cluster sellers the store
+            doesn't carry) and to remove (store products outside the cluster's top that make
+            up the store's bottom 10% of units). add and remove are empty when the store
+            sold nothing in the category. With peers, also the peers and their pooled
+            top products (peer_top); add and remove still follow the cluster
+    '''
+    df = as_sales_source(df)
+
+    clust = df.cluster_of(property_code)
+    result = _recommendation(property_code, category, month, num, clust, df.describe(property_code),
+                             sold_by_store(property_code, category, month, df),
+                             top_sold_by_cluster(clust, category, month, num, df),
+                             top_sold_overall(category, month, num, df))
+    if peers is not None:
+        peer_prods = top_sold_by_peers(peers, category, month, num, df)
+        result['peers'] = [_value(p) for p in peers]
+        result['peer_top'] = _ranked(peer_prods, num, np.sum(peer_prods.number_sold))
+    return result
+
+def _recommendation(property_code, category, month, num, clust, desc, store_prods, clust_prods, natl_prods):
+    '''
+    recommend's result from the slices it looked up
+    '''
+    result = {'property_code': property_code,
+              'category': category,
+              'month': month,
+              'num': num,
+              'cluster': _value(clust),
+              'flag_name': _value(desc.flag_name),
+              'city': _value(desc.city),
+              'state': _value(desc.state),
+              'sold_in_category': store_prods.shape[0] > 0,
+              'store': _ranked(store_prods, num),
+              'cluster_top': _ranked(clust_prods, num, np.sum(clust_prods.number_sold)),
+              'national_top': _ranked(natl_prods, num, np.sum(natl_prods.number_sold)),
+              'add': [],
+              'remove': []}
+    if store_prods.shape[0] == 0:
+        return result
+
+    # products suggested for removal are not in top 5 of cluster and are in the
+    # bottom 10% cumulative of sales
+    #change this to products that aren't in the top 10, not top 5
+    to_remove = store_prods[(~store_prods.description.isin(clust_prods.description.unique())) &
+                           (store_prods.cum_pct > .9)]
+    stocked = set(store_prods.description)
+    result['add'] = [_value(d) for d in clust_prods.description if d not in stocked]
+    result['remove'] = [{'description': _value(d), 'number_sold': _value(n), 'share': _value(sh)}
+                        for d, n, sh in zip(to_remove.description, to_remove.number_sold, to_remove.pct_of_sold)]
+    return result
+
+def recommend_many(pairs, month, num, df):
+    '''
+    inputs: pairs = iterable of (property_code, category)
+            month, num, df = as recommend; a DataFrame is aggregated once for all pairs
+    outputs: list of recommend results in the order of pairs, with {'property_code',
+            'category', 'error'} in place of a result for properties not in the data
+
+    Each national top is looked up once per category and each cluster top once per
+    (cluster, category). Sources with a sold_by_stores method (SqlSales) return every
+    store slice, cluster and description in one query instead of several per pair
+    '''
+    df = as_sales_source(df)
+    pairs = list(pairs)
+    stores = _StoreSlices(pairs, month, df)
+    clust_tops = {}
+    natl_tops = {}
+    results = []
+    for property_code, category in pairs:
+        clust = stores.cluster_of(property_code)
+        if pd.isnull(clust):
+            results.append({'property_code': property_code, 'category': category,
+                            'error': 'unknown property_code'})
+            continue
+        if (clust, category) not in clust_tops:
+            clust_tops[clust, category] = top_sold_by_cluster(clust, category, month, num, df)
+        if category not in natl_tops:
+            natl_tops[category] = top_sold_overall(category, month, num, df)
+        results.append(_recommendation(property_code, category, month, num, clust,
+                                       stores.describe(property_code),
+                                       stores.sold_by_store(property_code, category),
+                                       clust_tops[clust, category], natl_tops[category]))
+    return results
 
-def compare_products(property_code, category, month, num, df):
+class _StoreSlices(object):
+    '''
+    cluster_of, describe and sold_by_store of the properties in recommend_many's pairs,
+    fetched with a single sold_by_stores call when df has one and looked up in df otherwise
+    '''
+
+    def __init__(self, pairs, month, df):
+        self.month = month
+        self.df = df
+        self._rows = None
+        if hasattr(df, 'sold_by_stores') and pairs:
+            with timed('sold_by_stores'):
+                rows = df.sold_by_stores(sorted({p for p, c in pairs}), sorted({c for p, c in pairs}), month)
+            self._props = rows.drop_duplicates('property_code').set_index('property_code')
+            sold = rows[rows.description.notnull()].copy()
+            sold['number_sold'] = sold.number_sold.astype('int64')
+            self._slices = {key: g.reset_index(drop=True) for key, g in
+                            sold.groupby(['property_code', 'category_name'], sort=False)}
+            self._rows = rows
+
+    def cluster_of(self, property_code):
+        if self._rows is None:
+            return self.df.cluster_of(property_code)
+        if property_code not in self._props.index:
+            return np.nan
+        clust = self._props.cluster[property_code]
+        return clust if pd.isnull(clust) else int(clust)
+
+    def describe(self, property_code):
+        if self._rows is None:
+            return self.df.describe(property_code)
+        return self._props.loc[property_code, ['flag_name', 'city', 'state']]
+
+    def sold_by_store(self, property_code, category):
+        if self._rows is None:
+            return sold_by_store(property_code, category, self.month, self.df)
+        empty = self._rows.iloc[:0]
+        return self._slices.get((property_code, category), empty)
+
+def _share_lines(prods):
+    return [(0,'{0}. {1}: {2}%'.format(p['rank'], p['description'], round(100 * p['share'],1)))
+            for p in prods]
+
+def _peer_lines(peers, peer_top):
+    return [(1,'Similar hotels ({}) top products:'.format(len(peers)))] + _share_lines(peer_top)
+
+def add_peer_lines(lines, peers, category, month, num, df):
+    '''
+    inputs: lines = compare_products output without peers, e.g. read back from the batch
+                    recommendations (src/batch_recommender.py)
+            peers, category, month, num, df = as compare_products
+    outputs: lines with the similar hotels section added before the national top products,
+            where compare_products puts it
+    '''
+    peer_prods = top_sold_by_peers(peers, category, month, num, df)
+    section = _peer_lines(peers, _ranked(peer_prods, num, np.sum(peer_prods.number_sold)))
+    at = next((i for i, (level, text) in enumerate(lines)
+               if level == 1 and text.startswith('National top product')), len(lines))
+    return list(lines[:at]) + section + list(lines[at:])
+
+@timed('compare_products')
+def compare_products(property_code, category, month, num, df, peers = None):
     '''
     inputs: property_code
             category = product_category
-            month = transaction_month
+            month = transaction_month, or a (start, end) pair of months when df is a RangeCube
             num = number of products to compare
+            df = sales DataFrame, or a prebuilt SalesCube to skip the aggregation
+            peers = (optional) property_codes of similar hotels (see src/peer_index.py),
+                    whose pooled top products are listed next to the cluster's
     outputs: print outs of top selling products in that category by this store vs. 
             store clusters and nationaly. As well as suggestions for different products
-            in that category to stock and products to discontinue
+            in that category to stock and products to discontinue, formatted from recommend
     '''
     
     output = []
+    rec = recommend(property_code, category, month, num, df, peers)
+    clust = rec['cluster']
 
-    clust = np.max(df[(df.property_code == property_code)].cluster)
-    print('clust')
-    top_store_prods = sold_by_store(property_code, category, month, df).head(num)
-    print('top_store_prods')
-    store_prods = sold_by_store(property_code, category, month, df)
-    print('store_prods')
-    clust_prods = top_sold_by_cluster(clust, category, month, num, df)
-    tot_clust = np.sum(clust_prods.number_sold)
-    natl_prods = top_sold_overall(category, month, num, df)
-    tot_natl = np.sum(natl_prods.number_sold)
-    
-    desc = df[['flag_name','city','state']][df.property_code == property_code].iloc[0]
     output.append((1,'For store #{0}, {1}, {2}, {3}, for {4}, part of Cluster ({5})'.format(property_code,
-                                                     desc.flag_name,
-                                                     desc.city,
-                                                     desc.state,
-                                                     month,
+                                                     rec['flag_name'],
+                                                     rec['city'],
+                                                     rec['state'],
+                                                     month_label(month),
                                                      clust)))
-    
-    if store_prods.shape[0] == 0:
+
+    def peer_shares():
+        if peers is None:
+            return []
+        return _peer_lines(rec['peers'], rec['peer_top'])
+
+    if not rec['sold_in_category']:
         output.append((1,'No products sold in {}'.format(category)))
-        
-        if clust_prods.shape[0] < num:
-            n = clust_prods.shape[0]
-        else:
-            n = num
         output.append((1,'Cluster ({}) top products:'.format(clust)))
-        for i in range(n):
-            output.append((0,'{0}. {1}: {2}%'.format(i+1, clust_prods.description.iloc[i],
-                                    round(100 * clust_prods.number_sold.iloc[i]/tot_clust,1))))
-
-        if natl_prods.shape[0] < num:
-            n = natl_prods.shape[0]
-        else:
-            n = num
+        output.extend(_share_lines(rec['cluster_top']))
+        output.extend(peer_shares())
         output.append((1,'National top products in {}:'.format(category)))
-        for i in range(n):
-            output.append((0,'{0}. {1}: {2}%'.format(i+1, natl_prods.description.iloc[i],
-                                    round(100 * natl_prods.number_sold.iloc[i]/tot_natl,1))))
+        output.extend(_share_lines(rec['national_top']))
         return output
-        
-    
-    if sold_by_store(property_code, category, month, df).shape[0] < num:
-        n = sold_by_store(property_code, category, month, df).shape[0]
-    else:
-        n = num
+
     output.append((1,'Your top products in {}:'.format(category)))
-    for i in range(n):
-        output.append((0,'{0}. {1}: {2} units, {3}%'.format(i+1, top_store_prods.description.iloc[i],
-                                          top_store_prods.number_sold.iloc[i], 
-                                                 round(100 * top_store_prods.pct_of_sold.iloc[i],1))))
-    
-    if clust_prods.shape[0] < num:
-        n = clust_prods.shape[0]
-    else:
-        n = num
+    for p in rec['store']:
+        output.append((0,'{0}. {1}: {2} units, {3}%'.format(p['rank'], p['description'],
+                                          p['number_sold'], round(100 * p['share'],1))))
     output.append((1,'Cluster ({}) top products:'.format(clust)))
-    for i in range(n):
-        output.append((0,'{0}. {1}: {2}%'.format(i+1, clust_prods.description.iloc[i],
-                                round(100 * clust_prods.number_sold.iloc[i]/tot_clust,1))))
-    
-    if natl_prods.shape[0] < num:
-        n = natl_prods.shape[0]
-    else:
-        n = num
+    output.extend(_share_lines(rec['cluster_top']))
+    output.extend(peer_shares())
     output.append((1,('National top product:')))
-    for i in range(n):
-        output.append((0,'{0}. {1}: {2}%'.format(i+1, natl_prods.description.iloc[i],
-                                round(100 * natl_prods.number_sold.iloc[i]/tot_natl,1))))
-    
-    '''
-    products suggested for removal are not in top 5 of cluster and are in the
-    bottom 10% cumulative of sales
-    '''
-    
-    #change this to products that aren't in the top 10, not top 5
-    to_remove = store_prods[(~store_prods.description.isin(clust_prods.description.unique())) &
-                           (store_prods.cum_pct > .9)]
-    
-    if set(clust_prods.description) - set(store_prods.description) == set():
+    output.extend(_share_lines(rec['national_top']))
+
+    removals = [(0,'{0}. {1}: {2} units, {3}%'.format(i+1, p['description'], p['number_sold'],
+                                                      round(100 * p['share'],1)))
+                for i, p in enumerate(rec['remove'])]
+    if not rec['add']:
         output.append((1,'You are selling the top products already!'))
-        if to_remove.shape[0] > 0:
-            output.append((1,'Consider discontinue stocking:'))
-            for i in range(to_remove.shape[0]):
-                output.append((0,'{0}. {1}: {2} units, {3}%'.format(i+1, to_remove.description.iloc[i],
-                                                        to_remove.number_sold.iloc[i],
-                                                        round(100 * to_remove.pct_of_sold.iloc[i],1)))) 
     else:
         output.append((1,'Stocking suggestions:'))
-        add = list(set(clust_prods.description) - set(store_prods.description))
-        for idx, item in enumerate(add):
+        for idx, item in enumerate(rec['add']):
             output.append((0,'{0}. {1}'.format(idx+1, item)))
-        if to_remove.shape[0] > 0:
-            output.append((1,'Consider discontinue stocking:'))
-            for i in range(to_remove.shape[0]):
-                output.append((0,'{0}. {1}: {2} units, {3}%'.format(i+1, to_remove.description.iloc[i],
-                                                        to_remove.number_sold.iloc[i],
-                                                        round(100 * to_remove.pct_of_sold.iloc[i],1))))
+    if removals:
+        output.append((1,'Consider discontinue stocking:'))
+        output.extend(removals)
     
     return output
 
 if __name__ == "__main__":
     
-    print('getting data (this may take awhile)... ')
-    
-    sql = '''select * from product_category_recommender'''
-    sold = get_table(sql)
+    print('syncing local snapshot (only new or changed months are downloaded)... ')
+
+    snapshot = SalesSnapshot()
+    snapshot.sync()
+    sold = snapshot.load()
 
     print('analyzing...')
 
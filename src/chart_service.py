@@ -0,0 +1,150 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import sys
+sys.path.append("..")
+
+CHARTS = ['boxplot', 'distributions']
+FAILED = 'failed.txt' # marker written next to the charts when drawing them raised
+
+logger = logging.getLogger(__name__)
+
+
+def _render(data, description, month, cluster, paths):
+    '''
+    runs in a worker process: draws the price optimizer charts for one product.
+    Each file is written under a temporary name and renamed, so a browser never
+    loads a half written png
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    from src.price_optimizer import prod_subset
+
+    prod = prod_subset(data, description, month, cluster)
+    for chart, draw in [('boxplot', prod.boxplots), ('distributions', prod.dists)]:
+        tmp = paths[chart] + '.tmp.png'
+        draw(tmp)
+        if os.path.exists(tmp):
+            os.replace(tmp, paths[chart])
+    return paths
+
+def chart_key(data, description, month = None, cluster = None):
+    '''
+    hash of the product, filters and the data itself, so a chart is only redrawn when
+    something that changes it does
+    '''
+    key = hashlib.sha1(repr((description, month, cluster)).encode('utf-8'))
+    key.update(pd.util.hash_pandas_object(data, index=False).values.tobytes())
+    return key.hexdigest()
+
+
+class ChartRenderer(object):
+    '''
+    Draws the price optimizer charts in a pool of worker processes
+
+    Inputs:
+        out_dir = directory the pngs are written to (served as static files)
+        url_prefix = URL path of out_dir
+        processes = worker processes drawing charts
+        retry_failed = seconds before a chart that failed to draw is tried again
+        max_age = seconds a drawn chart is kept
+        max_files = most files kept in out_dir, the oldest are removed first
+        evict_interval = seconds between clean ups of out_dir
+
+    Charts are named by chart_key, so identical requests reuse the files already drawn
+    and concurrent requests for different products never overwrite each other. When a
+    render raises, the error is logged and a '<key>_failed.txt' marker is written, so the
+    page stops polling for the images and repeated requests don't resubmit the job.
+
+    Methods:
+        request(data, description, month, cluster) : dict of chart urls, plus 'ready'
+            (False while the charts are still being drawn in the background), 'failed'
+            (True if drawing them failed) and 'failed_url' (the marker the page polls)
+    '''
+
+    def __init__(self, out_dir, url_prefix = 'static/charts', processes = 2, retry_failed = 300,
+                 max_age = 24 * 3600, max_files = 2000, evict_interval = 300):
+        self.out_dir = out_dir
+        self.url_prefix = url_prefix
+        self.pool = ProcessPoolExecutor(processes)
+        self.retry_failed = retry_failed
+        self.max_age = max_age
+        self.max_files = max_files
+        self.evict_interval = evict_interval
+        self._pending = {}
+        self._last_evict = 0
+        self._lock = threading.Lock()
+        os.makedirs(out_dir, exist_ok=True)
+
+    def _failed(self, failed_path):
+        try:
+            return time.time() - os.path.getmtime(failed_path) < self.retry_failed
+        except FileNotFoundError:
+            return False
+
+    def request(self, data, description, month = None, cluster = None):
+        self._evict()
+        # only what prod_subset reads is hashed and shipped to the worker
+        data = data[[c for c in ['description', 'cluster', 'transaction_month', 'unit_price', 'number_sold']
+                     if c in data]]
+        # a subset of encoded sales still carries the whole shared dictionary as its categories,
+        # which would be hashed and pickled with every request
+        data = data.apply(lambda col: col.cat.remove_unused_categories()
+                          if isinstance(col.dtype, pd.CategoricalDtype) else col)
+        key = chart_key(data, description, month, cluster)
+        paths = {chart: os.path.join(self.out_dir, '{}_{}.png'.format(key, chart)) for chart in CHARTS}
+        urls = {chart: '{}/{}_{}.png'.format(self.url_prefix, key, chart) for chart in CHARTS}
+        failed_path = os.path.join(self.out_dir, '{}_{}'.format(key, FAILED))
+        urls['failed_url'] = '{}/{}_{}'.format(self.url_prefix, key, FAILED)
+
+        ready = all(os.path.exists(path) for path in paths.values())
+        failed = not ready and self._failed(failed_path)
+        if not ready and not failed:
+            with self._lock:
+                future = self._pending.get(key)
+                if future is None or future.done():
+                    future = self.pool.submit(_render, data, description, month, cluster, paths)
+                    future.add_done_callback(lambda f: self._done(key, f, failed_path))
+                    self._pending[key] = future
+        urls['ready'] = ready
+        urls['failed'] = failed
+        return urls
+
+    def _done(self, key, future, failed_path):
+        with self._lock:
+            self._pending.pop(key, None)
+        error = future.exception()
+        if error is None:
+            return
+        logger.error('drawing charts %s failed', key, exc_info=error)
+        try:
+            with open(failed_path, 'w') as f:
+                f.write(repr(error))
+        except OSError:
+            logger.exception('could not write %s', failed_path)
+
+    def _evict(self):
+        '''
+        removes charts older than max_age, then the oldest ones past max_files
+        '''
+        now = time.time()
+        if now - self._last_evict < self.evict_interval:
+            return
+        self._last_evict = now
+        files = []
+        for entry in os.scandir(self.out_dir):
+            try:
+                files.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError: # removed by another process
+                continue
+        files.sort(reverse=True)
+        for n, (mtime, path) in enumerate(files):
+            if n >= self.max_files or now - mtime > self.max_age:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
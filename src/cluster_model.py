@@ -0,0 +1,118 @@
+import os
+import time
+import pickle
+import threading
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+import sys
+sys.path.append("..")
+from src.get_clusters import prepare_properties, push_table
+
+MODEL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'models')
+LATEST = 'cluster_model_latest.txt'
+
+
+class ClusterModel(object):
+    '''
+    Property feature encoding and cluster centroids saved from a get_clusters run
+
+    Inputs:
+        encoder = fitted PropertyFeatures used to build the clustering matrix
+        centroids = (n_clusters x n_features) mean feature vector of each cluster
+        clusters = cluster label of each centroid row
+        mgmt_counts = properties per management_company_id at fit time
+        version = model version, a timestamp by default
+
+    A new or changed property is placed in the cluster with the nearest centroid, which
+    costs O(n_clusters x n_features) no matter how many properties were clustered.
+
+    Methods:
+        fit(props, encoder, X, labels) : builds a model from a clustering run
+        features(property_row) : feature vector of one property
+        assign_cluster(property_row) : cluster for one property
+        save(path) / load(path, version) : versioned pickles under models/
+    '''
+
+    def __init__(self, encoder, centroids, clusters, mgmt_counts, version = None):
+        self.encoder = encoder
+        self.centroids = np.asarray(centroids, dtype=float)
+        self.clusters = np.asarray(clusters)
+        self.mgmt_counts = dict(mgmt_counts)
+        self.version = version or time.strftime('%Y%m%d%H%M%S')
+
+    @classmethod
+    def fit(cls, props, encoder, X, labels):
+        '''
+        inputs:
+            props = prepared property rows (see prepare_properties)
+            encoder = PropertyFeatures fitted on props
+            X = sparse feature matrix the clustering was fit on
+            labels = cluster of each row of X
+        '''
+        clusters, codes = np.unique(np.asarray(labels), return_inverse=True)
+        members = sp.csr_matrix((np.ones(len(codes)), (codes, np.arange(len(codes)))),
+                                shape=(len(clusters), len(codes)))
+        sizes = np.asarray(members.sum(axis=1)).ravel()
+        centroids = np.asarray((members @ X).todense()) / sizes[:, None]
+        mgmt_counts = props['management_company_id'].value_counts()
+        return cls(encoder, centroids, clusters, mgmt_counts.to_dict())
+
+    def features(self, property_row):
+        row = prepare_properties(pd.DataFrame([dict(property_row)]), pd.Series(self.mgmt_counts),
+                                 drop_unmanaged=False)
+        return self.encoder.transform(row).toarray()[0]
+
+    def assign_cluster(self, property_row):
+        x = self.features(property_row)
+        return self.clusters[np.argmin(((self.centroids - x) ** 2).sum(axis=1))]
+
+    def save(self, path = MODEL_DIR):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'cluster_model_{}.pkl'.format(self.version)), 'wb') as f:
+            pickle.dump(self, f)
+        with open(os.path.join(path, LATEST), 'w') as f:
+            f.write(self.version)
+
+    @classmethod
+    def load(cls, path = MODEL_DIR, version = None):
+        if version is None:
+            with open(os.path.join(path, LATEST)) as f:
+                version = f.read().strip()
+        with open(os.path.join(path, 'cluster_model_{}.pkl'.format(version)), 'rb') as f:
+            return pickle.load(f)
+
+_model = None
+_model_lock = threading.Lock()
+
+def latest_model():
+    '''
+    latest saved ClusterModel, loaded once per process
+    '''
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = ClusterModel.load()
+    return _model
+
+def assign_cluster(property_row, model = None):
+    '''
+    inputs:
+        property_row = dict / Series with the columns selected in get_clusters
+        model = (optional) ClusterModel, defaults to the latest saved one
+
+    outputs:
+        cluster for the property, without refitting
+    '''
+    return (model or latest_model()).assign_cluster(property_row)
+
+def onboard_property(property_row, model = None):
+    '''
+    assigns a cluster to a new property and appends it to property_clusters
+    '''
+    model = model or latest_model()
+    row = prepare_properties(pd.DataFrame([dict(property_row)]), pd.Series(model.mgmt_counts),
+                             drop_unmanaged=False)
+    row['cluster'] = model.assign_cluster(property_row)
+    push_table(row, 'property_clusters', if_exists='append')
+    return row['cluster'].iloc[0]
@@ -0,0 +1,125 @@
+import time
+import tracemalloc
+import argparse
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+from sklearn.cluster import AgglomerativeClustering, Birch, MiniBatchKMeans
+from sklearn.neighbors import kneighbors_graph
+from sklearn.metrics import adjusted_rand_score
+
+
+def _dense(X):
+    # AgglomerativeClustering doesn't take sparse input
+    return X.toarray() if sp.issparse(X) else X
+
+def _ward(X, n_clusters, random_state, **kwargs):
+    # full Ward linkage: O(n^2) memory, the original get_clusters model
+    return AgglomerativeClustering(n_clusters=n_clusters).fit_predict(_dense(X))
+
+def _ward_knn(X, n_clusters, random_state, n_neighbors = 15, **kwargs):
+    # Ward restricted to merging k-nearest-neighbour pairs, memory grows with n * n_neighbors
+    connectivity = kneighbors_graph(X, n_neighbors=n_neighbors, include_self=False)
+    return AgglomerativeClustering(n_clusters=n_clusters, linkage='ward',
+                                   connectivity=connectivity).fit_predict(_dense(X))
+
+def _spread(X):
+    '''
+    root of the summed column variances: the typical distance of a row from the mean row
+    '''
+    if sp.issparse(X):
+        X = sp.csr_matrix(X, dtype=float)
+        mean = np.asarray(X.mean(axis=0)).ravel()
+        return np.sqrt(max((X.multiply(X).sum() / X.shape[0]) - (mean ** 2).sum(), 0))
+    return np.sqrt(np.var(np.asarray(X, dtype=float), axis=0).sum())
+
+def _birch(X, n_clusters, random_state, threshold = None, relative_threshold = 0.2, **kwargs):
+    # one pass into a CF-tree, then Ward over the (few) subcluster centroids. The radius
+    # follows the spread of X, so unscaled columns (rooms in the hundreds) don't leave
+    # every point in its own subcluster and the Ward step back at O(n^2)
+    if threshold is None:
+        threshold = relative_threshold * _spread(X) or 0.5
+    return Birch(n_clusters=AgglomerativeClustering(n_clusters=n_clusters),
+                 threshold=threshold).fit_predict(X)
+
+def _minibatch_kmeans(X, n_clusters, random_state, batch_size = 2048, **kwargs):
+    return MiniBatchKMeans(n_clusters=n_clusters, batch_size=batch_size, n_init=3,
+                           random_state=random_state).fit_predict(X)
+
+CLUSTERING_METHODS = {'ward': _ward,
+                      'ward_knn': _ward_knn,
+                      'birch': _birch,
+                      'minibatch_kmeans': _minibatch_kmeans}
+
+def fit_clusters(X, method = 'ward', n_clusters = 6, random_state = 0, **kwargs):
+    '''
+    inputs:
+        X = property feature matrix (DataFrame, array or scipy sparse; the ward methods
+            densify it)
+        method = one of CLUSTERING_METHODS
+        n_clusters = number of clusters
+        kwargs = passed to the method (n_neighbors, threshold / relative_threshold, batch_size)
+
+    outputs:
+        array of cluster labels, one per row of X
+    '''
+    if method not in CLUSTERING_METHODS:
+        raise ValueError('unknown clustering method {}, choose from {}'.format(method, sorted(CLUSTERING_METHODS)))
+    return CLUSTERING_METHODS[method](X, n_clusters, random_state, **kwargs)
+
+def benchmark(X, methods = None, n_clusters = 6, reference = 'ward', max_reference_rows = 20000):
+    '''
+    times each clustering method on X and compares its labels to the reference method
+
+    outputs:
+        DataFrame with seconds, peak traced memory (MB) and adjusted Rand index against
+        the reference (ari_vs_reference) for every method. The reference is skipped above max_reference_rows,
+        where full Ward no longer fits in memory. peak_mb only counts what tracemalloc
+        sees: Python objects and numpy arrays, not scipy / sklearn's own C allocations
+        (e.g. the linkage tree), so it understates the Ward methods in particular
+    '''
+    methods = methods or list(CLUSTERING_METHODS)
+    if X.shape[0] > max_reference_rows:
+        methods = [m for m in methods if m != reference]
+        reference = None
+
+    labels = {}
+    results = []
+    for method in ([reference] if reference else []) + [m for m in methods if m != reference]:
+        tracemalloc.start()
+        start = time.perf_counter()
+        labels[method] = fit_clusters(X, method, n_clusters)
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append({'method': method,
+                        'rows': X.shape[0],
+                        'seconds': seconds,
+                        'peak_mb': peak / 1024**2,
+                        'ari_vs_reference': adjusted_rand_score(labels[reference], labels[method])
+                            if reference else np.nan})
+    return pd.DataFrame(results)
+
+def random_property_features(n, seed = 0):
+    '''
+    stand-in for the get_clusters feature matrix: rooms and props_under_mgmt plus one-hot
+    kind / location_type / flag_name / zip zone columns
+    '''
+    rng = np.random.RandomState(seed)
+    numeric = np.column_stack([rng.lognormal(4.5, 0.5, n), rng.geometric(0.05, n)])
+    blocks = [numeric]
+    for levels in [3, 4, 60, 10]:
+        codes = rng.randint(0, levels, n)
+        blocks.append(np.eye(levels)[codes][:, 1:]) # drop_first, like get_dummies in get_clusters
+    return np.hstack(blocks)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='benchmark clustering backends against full Ward')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000, 50000])
+    parser.add_argument('--methods', nargs='+', default=None, choices=sorted(CLUSTERING_METHODS))
+    args = parser.parse_args()
+
+    for n in args.sizes:
+        print(benchmark(random_property_features(n), args.methods).to_string(index=False))
+        print('')
@@ -0,0 +1,127 @@
+import os
+import threading
+from contextlib import contextmanager
+import psycopg2 as pg2
+from psycopg2 import pool as pg2_pool
+from sqlalchemy import create_engine
+
+# pool settings, change with configure_pool() before the first query
+POOL_MAXCONN = 10
+# ThreadedConnectionPool closes a returned connection once minconn are idle, so a smaller
+# minconn means reconnecting under load; keep it at maxconn unless connections are scarce
+POOL_MINCONN = POOL_MAXCONN
+POOL_PRE_PING = True # check a connection with SELECT 1 before handing it out
+
+_pools = {}
+_engines = {}
+_lock = threading.Lock()
+
+
+class _BlockingPool(object):
+    '''
+    psycopg2's ThreadedConnectionPool raises when every connection is checked out.
+    This waits for one to be returned instead, so a burst of requests queues up
+    rather than erroring out.
+    '''
+
+    def __init__(self, minconn, maxconn, **kwargs):
+        self.pool = pg2_pool.ThreadedConnectionPool(minconn, maxconn, **kwargs)
+        self.slots = threading.BoundedSemaphore(maxconn)
+
+    def getconn(self):
+        self.slots.acquire()
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self.slots.release()
+            raise
+
+    def putconn(self, conn, close = False):
+        try:
+            self.pool.putconn(conn, close=close)
+        finally:
+            self.slots.release()
+
+    def closeall(self):
+        self.pool.closeall()
+
+
+def configure_pool(minconn = None, maxconn = None, pre_ping = None):
+    '''
+    sets the pool size / health check used for every database and closes any open
+    pools so the new settings take effect on the next query. minconn follows maxconn
+    unless it is given
+    '''
+    global POOL_MINCONN, POOL_MAXCONN, POOL_PRE_PING
+    if maxconn is not None:
+        POOL_MAXCONN = maxconn
+        POOL_MINCONN = maxconn
+    if minconn is not None:
+        POOL_MINCONN = minconn
+    if pre_ping is not None:
+        POOL_PRE_PING = pre_ping
+    close_pools()
+
+def close_pools():
+    with _lock:
+        for pool in _pools.values():
+            pool.closeall()
+        for engine in _engines.values():
+            engine.dispose()
+        _pools.clear()
+        _engines.clear()
+
+def _get_pool(db, user, host, port):
+    # keyed by pid too: connections must not be shared with forked worker processes
+    key = (os.getpid(), db, user, host, port)
+    with _lock:
+        if key not in _pools:
+            _pools[key] = _BlockingPool(POOL_MINCONN, POOL_MAXCONN,
+                                        dbname=db, user=user, host=host, port=port)
+        return _pools[key]
+
+def _healthy(conn):
+    if conn.closed:
+        return False
+    if not POOL_PRE_PING:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute('SELECT 1')
+        cur.close()
+        conn.rollback()
+        return True
+    except pg2.Error:
+        return False
+
+@contextmanager
+def connection(db = 'xxx', user = 'postgres', host = 'localhost', port = '0000'):
+    '''
+    checks a healthy psycopg2 connection out of the pool for the duration of the block.
+    Commits on success, rolls back on error, and drops the connection if it broke
+    '''
+    pool = _get_pool(db, user, host, port)
+    conn = pool.getconn()
+    if not _healthy(conn):
+        pool.putconn(conn, close=True)
+        conn = pool.getconn()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    finally:
+        pool.putconn(conn, close=bool(conn.closed))
+
+def get_engine(db = 'xxx', user = 'postgres', host = 'localhost', port = '0000'):
+    '''
+    returns a SQLAlchemy engine (with its own pool) shared by every caller in this process
+    '''
+    key = (os.getpid(), db, user, host, port)
+    with _lock:
+        if key not in _engines:
+            _engines[key] = create_engine('postgresql+psycopg2://'+user+':@'+host+':'+port+'/'+db,
+                                          pool_size=POOL_MAXCONN, pool_pre_ping=POOL_PRE_PING)
+        return _engines[key]
@@ -0,0 +1,111 @@
+import time
+import threading
+import sys
+sys.path.append("..")
+from src.get_clusters import get_table, execute_sql
+
+# every list comes from a dimension table, one row per property or category, except
+# months, which walks the transaction_month index one distinct value at a time instead
+# of scanning the fact table
+DIMENSION_SQL = {
+    'property_codes': 'SELECT property_code FROM property_code_lookup ORDER BY property_code',
+    'categories': 'SELECT name FROM categories ORDER BY name',
+    'flags': 'SELECT DISTINCT flag_name FROM property_code_lookup ORDER BY flag_name',
+    'cities': 'SELECT DISTINCT city FROM property_code_lookup ORDER BY city',
+    'states': 'SELECT DISTINCT state FROM property_code_lookup ORDER BY state',
+    'months': '''WITH RECURSIVE m AS (
+                    (SELECT transaction_month FROM product_category_recommender
+                        ORDER BY transaction_month DESC LIMIT 1)
+                    UNION ALL
+                    SELECT (SELECT transaction_month FROM product_category_recommender
+                                WHERE transaction_month < m.transaction_month
+                                ORDER BY transaction_month DESC LIMIT 1)
+                    FROM m WHERE m.transaction_month IS NOT NULL)
+                SELECT transaction_month FROM m WHERE transaction_month IS NOT NULL''',
+    }
+
+INDEX_SQL = 'CREATE INDEX IF NOT EXISTS product_category_recommender_month ON product_category_recommender (transaction_month)'
+
+
+def create_indexes():
+    '''
+    the months query only avoids a full scan with an index on transaction_month
+    '''
+    execute_sql(INDEX_SQL)
+
+def _query_loader(sql, read):
+    return lambda: list(read(sql, None).iloc[:,0])
+
+
+class Dimensions(object):
+    '''
+    Lazily loaded lists of property codes, months, categories, flags, cities and states
+
+    Inputs:
+        queries = name -> SQL returning the list in its first column
+        ttl = seconds a list is served before it is refreshed
+        read = (optional) function(sql, params) returning a DataFrame, get_table by default
+
+    Nothing is read until a list is first asked for. After that a stale list keeps being
+    served while one background thread reloads it, so requests never wait on a refresh.
+
+    Methods:
+        get(name) : the list, loading it on first use
+        set_loader(name, loader) : reads name from function() instead of SQL
+        on_change(name, callback) : calls callback(new list) whenever a refresh changes it
+        refresh(name) : reloads now, all lists if name is None
+    '''
+
+    def __init__(self, queries = DIMENSION_SQL, ttl = 600, read = None):
+        self.ttl = ttl
+        read = read or (lambda sql, params: get_table(sql, params=params))
+        self._loaders = {name: _query_loader(sql, read) for name, sql in queries.items()}
+        self._values = {} # name -> (list, loaded_at)
+        self._callbacks = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def set_loader(self, name, loader):
+        self._loaders[name] = loader
+
+    def on_change(self, name, callback):
+        self._callbacks.setdefault(name, []).append(callback)
+
+    def get(self, name):
+        entry = self._values.get(name)
+        if entry is None:
+            return self.refresh(name)
+        if time.time() - entry[1] > self.ttl:
+            with self._lock:
+                start = name not in self._refreshing
+                self._refreshing.add(name)
+            if start:
+                threading.Thread(target=self._background_refresh, args=(name,), daemon=True).start()
+        return entry[0]
+
+    def _background_refresh(self, name):
+        try:
+            self.refresh(name)
+        finally:
+            with self._lock:
+                self._refreshing.discard(name)
+
+    def refresh(self, name = None):
+        if name is None:
+            for name in self._loaders:
+                self.refresh(name)
+            return None
+        values = list(self._loaders[name]())
+        old = self._values.get(name)
+        self._values[name] = (values, time.time())
+        if old is not None and old[0] != values:
+            for callback in self._callbacks.get(name, []):
+                callback(values)
+        return values
+
+if __name__ == "__main__":
+
+    create_indexes()
+    dimensions = Dimensions()
+    for name in DIMENSION_SQL:
+        print('{}: {} values'.format(name, len(dimensions.get(name))))
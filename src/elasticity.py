@@ -0,0 +1,217 @@
+import json
+import time
+import logging
+import argparse
+import threading
+import multiprocessing as mp
+import pandas as pd
+import numpy as np
+from scipy.interpolate import UnivariateSpline, splev
+import sys
+sys.path.append("..")
+from src.get_clusters import get_table, push_table
+
+ELASTICITY_TABLE = 'product_elasticity'
+SPLINE_SMOOTHING = 1000000 # same smoothing factor as prod_subset.scatplot
+
+logger = logging.getLogger(__name__)
+
+
+def _price_points(df, by):
+    '''
+    average number sold per unit price of every product, as prod_subset.data
+    '''
+    data = df.groupby(by + ['unit_price'], observed=True)['number_sold'].mean().reset_index()
+    return data[(data.unit_price > 0) & (data.number_sold > 0)]
+
+def fit_loglog(points, by):
+    '''
+    least squares fit of log(number_sold) = intercept + elasticity * log(unit_price) for
+    every group at once, from per-group sums
+
+    outputs:
+        DataFrame of by, n_prices, price_min, price_max, intercept, elasticity, r2
+    '''
+    pts = points[by].copy()
+    pts['x'] = np.log(points.unit_price)
+    pts['y'] = np.log(points.number_sold)
+    pts['xx'] = pts.x ** 2
+    pts['xy'] = pts.x * pts.y
+    pts['yy'] = pts.y ** 2
+    sums = pts.groupby(by, observed=True)[['x', 'y', 'xx', 'xy', 'yy']].sum()
+    n = pts.groupby(by, observed=True).size()
+
+    sxx = sums.xx - sums.x ** 2 / n
+    sxy = sums.xy - sums.x * sums.y / n
+    syy = sums.yy - sums.y ** 2 / n
+    fit = pd.DataFrame({'n_prices': n,
+                        'price_min': points.groupby(by, observed=True).unit_price.min(),
+                        'price_max': points.groupby(by, observed=True).unit_price.max()})
+    fit['elasticity'] = sxy / sxx.replace(0, np.nan)
+    fit['intercept'] = (sums.y - fit.elasticity * sums.x) / n
+    fit['r2'] = sxy ** 2 / (sxx * syy).replace(0, np.nan)
+    return fit.reset_index()
+
+def _fit_splines(groups):
+    '''
+    runs in a worker process: UnivariateSpline of number sold vs. price per product
+    '''
+    out = []
+    for key, x, y in groups:
+        spl = UnivariateSpline(x, y)
+        spl.set_smoothing_factor(SPLINE_SMOOTHING)
+        out.append((key, json.dumps(spl.get_knots().tolist()), json.dumps(spl.get_coeffs().tolist())))
+    return out
+
+def fit_splines(points, by, processes = None):
+    '''
+    outputs:
+        DataFrame of by, spline_knots, spline_coefs (JSON lists) for every product with
+        at least 4 prices (the minimum for a cubic spline)
+    '''
+    groups = [(key, g.unit_price.values, g.number_sold.values)
+              for key, g in points.groupby(by, observed=True) if g.shape[0] > 3]
+    processes = processes or mp.cpu_count()
+    chunks = [groups[i::processes * 4] for i in range(processes * 4)]
+    with mp.Pool(processes) as pool:
+        results = pool.map(_fit_splines, [c for c in chunks if c])
+
+    rows = []
+    for key, knots, coefs in [r for chunk in results for r in chunk]:
+        key = key if isinstance(key, tuple) else (key,)
+        rows.append(dict(zip(by, key), spline_knots=knots, spline_coefs=coefs))
+    return pd.DataFrame(rows, columns=by + ['spline_knots', 'spline_coefs'])
+
+def fit_demand_curves(df, by = ('description',), processes = None):
+    '''
+    inputs:
+        df = DataFrame containing sales data with a unit_price column
+        by = columns that define one product, e.g. ('description', 'cluster')
+        processes = worker processes for the spline fits
+
+    outputs:
+        one row per product with the log-log elasticity fit and the spline coefficients
+    '''
+    by = list(by)
+    points = _price_points(df, by)
+    curves = fit_loglog(points, by)
+    splines = fit_splines(points, by, processes)
+    return curves.merge(splines, on=by, how='left')
+
+def predict_sales(curve, price, method = 'loglog'):
+    '''
+    inputs:
+        curve = one row of the elasticity table (dict or Series)
+        price = unit price (or array of prices) to evaluate
+        method = 'loglog' or 'spline'
+
+    outputs:
+        expected average number sold at that price
+    '''
+    if method == 'spline':
+        if not isinstance(curve['spline_knots'], str):
+            return np.nan
+        knots = np.array(json.loads(curve['spline_knots']))
+        coefs = np.array(json.loads(curve['spline_coefs']))
+        # UnivariateSpline stores interior + boundary knots; splev wants them padded to degree 3
+        t = np.concatenate([[knots[0]] * 3, knots, [knots[-1]] * 3])
+        return splev(price, (t, np.concatenate([coefs, np.zeros(4)]), 3))
+    return np.exp(curve['intercept']) * np.power(price, curve['elasticity'])
+
+def parse_price(text):
+    '''
+    unit price typed into the what-if box, None if it isn't a positive number
+    '''
+    try:
+        price = float(text)
+    except (TypeError, ValueError):
+        return None
+    return price if np.isfinite(price) and price > 0 else None
+
+
+class ElasticityTable(object):
+    '''
+    In-memory copy of the product_elasticity table for price what-if queries
+
+    Inputs:
+        by = columns the table was fit by
+        table = table name
+        read = (optional) function(sql, params) returning a DataFrame, get_table by default
+        ttl = seconds before the table is re-read, like MonthCache
+        retry = seconds before a table that couldn't be read is tried again
+
+    The table is read on first use and again after ttl. If reading it fails (e.g. the
+    fit has never been run) the error is logged and the last copy, or an empty one, is
+    served until retry has passed.
+
+    Methods:
+        what_if(key, price, method) : expected sales and revenue at price, or None if the
+            product wasn't fit. key is the description, or a tuple of the by columns
+    '''
+
+    def __init__(self, by = ('description',), table = ELASTICITY_TABLE, read = None, ttl = 3600, retry = 60):
+        self.by = list(by)
+        self.table = table
+        self.read = read or (lambda sql, params: get_table(sql, params=params))
+        self.ttl = ttl
+        self.retry = retry
+        self._curves = None
+        self._expires = 0
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._curves is None or time.time() >= self._expires:
+                try:
+                    curves = self.read('SELECT * FROM {}'.format(self.table), None)
+                except Exception:
+                    logger.warning('could not read %s', self.table, exc_info=True)
+                    self._curves = self._curves or {}
+                    self._expires = time.time() + self.retry
+                else:
+                    keys = curves[self.by].itertuples(index=False, name=None)
+                    self._curves = dict(zip([k if len(self.by) > 1 else k[0] for k in keys],
+                                            curves.to_dict('records')))
+                    self._expires = time.time() + self.ttl
+            return self._curves
+
+    def what_if(self, key, price, method = 'loglog'):
+        '''
+        outputs:
+            dict of price, sales, revenue, elasticity and the fitted price range, or None if
+            there is no usable curve for key (e.g. it only ever sold at one price)
+        '''
+        curve = self._load().get(key)
+        if curve is None or pd.isnull(curve['elasticity']):
+            return None
+        if method == 'spline' and not isinstance(curve.get('spline_knots'), str):
+            return None
+        sales = float(predict_sales(curve, price, method))
+        if np.isnan(sales):
+            return None
+        return {'price': price, 'sales': sales, 'revenue': price * sales,
+                'elasticity': curve['elasticity'], 'price_min': curve['price_min'],
+                'price_max': curve['price_max']}
+
+if __name__ == "__main__":
+
+    from src.snapshot import SalesSnapshot
+
+    parser = argparse.ArgumentParser(description='fit demand curves for every product and write them to the db')
+    parser.add_argument('--by', nargs='+', default=['description'],
+                        help='columns defining a product, e.g. description cluster')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    print('syncing local snapshot...')
+    snapshot = SalesSnapshot()
+    snapshot.sync()
+    sold = snapshot.load(columns=list(set(args.by) | {'description', 'number_sold', 'dollars_sold'}))
+    sold['unit_price'] = np.round(sold.dollars_sold / sold.number_sold, 2)
+
+    print('fitting...')
+    curves = fit_demand_curves(sold, args.by, args.processes)
+
+    print('writing {} rows to db...'.format(curves.shape[0]))
+    push_table(curves, ELASTICITY_TABLE, atomic=True)
+    print('complete.')
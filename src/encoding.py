@@ -0,0 +1,113 @@
+import threading
+import pandas as pd
+import numpy as np
+import sys
+sys.path.append("..")
+from src.get_clusters import get_table
+
+# string columns of the sales frames that are stored as pandas categoricals
+CATEGORICAL_COLS = ['description', 'category_name', 'property_code', 'flag_name',
+                    'city', 'state', 'transaction_month']
+# categoricals kept sorted and ordered, so min / max / comparisons work on them
+ORDERED_COLS = ['transaction_month']
+
+
+class SalesDictionary(object):
+    '''
+    Shared category lists for the string columns of the sales frames
+
+    Every frame encoded with the same dictionary maps a given description, property_code,
+    etc. to the same integer code, so frames loaded at different times (month slices,
+    snapshot partitions) can be compared without re-encoding. Categories are sorted when
+    a column is first seen; values that show up later are appended so existing codes
+    never change. ORDERED_COLS (transaction_month) are the exception: they stay sorted
+    and ordered, so a month older than every known one shifts their codes.
+
+    A frame encoded before the dictionary grew still has the smaller dtype, and
+    pd.concat of frames with different dtypes falls back to object columns, so
+    concatenate with concat_sales.
+
+    Methods:
+        update(df) : adds any values of df not seen yet
+        dtype(col) : CategoricalDtype to encode col with
+    '''
+
+    def __init__(self):
+        self.categories = {}
+        self._lock = threading.Lock()
+
+    def update(self, df):
+        with self._lock:
+            for col in CATEGORICAL_COLS:
+                if col not in df:
+                    continue
+                if isinstance(df[col].dtype, pd.CategoricalDtype):
+                    values = df[col].cat.categories
+                else:
+                    values = pd.Index(df[col].dropna().unique())
+                known = self.categories.get(col)
+                if known is None:
+                    self.categories[col] = values.sort_values()
+                else:
+                    new = values.difference(known)
+                    if len(new) > 0 and col in ORDERED_COLS:
+                        self.categories[col] = known.append(new).sort_values()
+                    elif len(new) > 0:
+                        self.categories[col] = known.append(new.sort_values())
+
+    def dtype(self, col):
+        return pd.CategoricalDtype(self.categories[col], ordered=col in ORDERED_COLS)
+
+def _downcast_int(col):
+    '''
+    int64 -> int32 when the values fit. Kept at 32 bits (not the smallest type that fits)
+    so running sums over a column don't overflow
+    '''
+    info = np.iinfo(np.int32)
+    if col.shape[0] == 0 or (col.min() >= info.min and col.max() <= info.max):
+        return col.astype(np.int32)
+    return col
+
+def encode_sales(df, dictionary = None):
+    '''
+    inputs:
+        df = sales DataFrame with string columns
+        dictionary = (optional) SalesDictionary shared with other frames
+
+    outputs:
+        DataFrame with CATEGORICAL_COLS as categoricals and int64 columns downcast.
+        Floats (dollars_sold, unit prices) are left at 64 bits to keep cents exact
+    '''
+    if dictionary is None:
+        dictionary = SalesDictionary()
+    dictionary.update(df)
+
+    out = {}
+    for col in df.columns:
+        if col in CATEGORICAL_COLS:
+            out[col] = df[col].astype(dictionary.dtype(col))
+        elif pd.api.types.is_integer_dtype(df[col]) and df[col].dtype.itemsize > 4:
+            out[col] = _downcast_int(df[col])
+        else:
+            out[col] = df[col]
+    return pd.DataFrame(out, index=df.index)
+
+def concat_sales(frames, dictionary):
+    '''
+    inputs:
+        frames = DataFrames encoded with dictionary, possibly before it last grew
+        dictionary = the SalesDictionary they were encoded with
+
+    outputs:
+        one DataFrame, with every categorical column on the dictionary's current dtype
+        (only the integer codes are remapped, no strings are rebuilt)
+    '''
+    frames = [f.astype({col: dictionary.dtype(col) for col in CATEGORICAL_COLS if col in f})
+              for f in frames]
+    return pd.concat(frames, ignore_index=True)
+
+def load_sales(sql, params = None, dictionary = None):
+    '''
+    get_table, returning the compact encoded frame
+    '''
+    return encode_sales(get_table(sql, params=params), dictionary)
@@ -0,0 +1,82 @@
+import pandas as pd
+import numpy as np
+import scipy.sparse as sp
+
+NUMERIC_COLS = ['props_under_mgmt', 'rooms']
+DUMMY_COLS = ['kind', 'guest_profile', 'location_type', 'currency', 'flag_name', 'zip']
+
+
+class PropertyFeatures(object):
+    '''
+    Builds the property clustering matrix as a scipy sparse matrix in one pass
+
+    Inputs:
+        numeric_cols = columns used as numbers, standard scaled when scale = True
+        dummy_cols = columns one-hot encoded like pd.get_dummies (columns named '<col>_<value>')
+        drop_first = drop the first (alphabetical) level of every dummy column, as get_dummies does
+        scale = standard scale the numeric columns so rooms doesn't outweigh every one-hot column
+
+    The vocabulary (levels of each dummy column) and the scaling are fixed by fit(), so
+    transform() gives the same columns for the full fleet or for a single new property.
+    Levels not seen at fit time encode as all zeros.
+
+    Methods:
+        fit(props) : learns the vocabulary and scaling
+        transform(props) : CSR matrix, one row per property
+        fit_transform(props)
+
+    Attributes:
+        columns_ : feature names in column order
+        vocabulary_ : kept levels of each dummy column
+        mean_, scale_ : numeric scaling
+    '''
+
+    def __init__(self, numeric_cols = NUMERIC_COLS, dummy_cols = DUMMY_COLS, drop_first = True, scale = True):
+        self.numeric_cols = list(numeric_cols)
+        self.dummy_cols = list(dummy_cols)
+        self.drop_first = drop_first
+        self.scale = scale
+
+    def fit(self, props):
+        self.vocabulary_ = {}
+        for col in self.dummy_cols:
+            levels = pd.Index(props[col].dropna().unique()).sort_values()
+            self.vocabulary_[col] = levels[1:] if self.drop_first else levels
+
+        numeric = props[self.numeric_cols].astype(float)
+        if self.scale:
+            self.mean_ = numeric.mean().values
+            self.scale_ = numeric.std(ddof=0).replace(0, 1).values
+        else:
+            self.mean_ = np.zeros(len(self.numeric_cols))
+            self.scale_ = np.ones(len(self.numeric_cols))
+
+        self.columns_ = list(self.numeric_cols)
+        for col in self.dummy_cols:
+            self.columns_ += ['{}_{}'.format(col, level) for level in self.vocabulary_[col]]
+        return self
+
+    def transform(self, props):
+        n = props.shape[0]
+        rows, cols, vals = [], [], []
+
+        numeric = (props[self.numeric_cols].astype(float).values - self.mean_) / self.scale_
+        for j in range(len(self.numeric_cols)):
+            rows.append(np.arange(n))
+            cols.append(np.full(n, j))
+            vals.append(numeric[:, j])
+
+        offset = len(self.numeric_cols)
+        for col in self.dummy_cols:
+            codes = pd.Categorical(props[col], categories=self.vocabulary_[col]).codes
+            hit = codes >= 0 # -1 is the dropped first level, missing, or unseen
+            rows.append(np.flatnonzero(hit))
+            cols.append(offset + codes[hit])
+            vals.append(np.ones(hit.sum()))
+            offset += len(self.vocabulary_[col])
+
+        return sp.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                             shape=(n, len(self.columns_)))
+
+    def fit_transform(self, props):
+        return self.fit(props).transform(props)
@@ -2,39 +2,97 @@ import pandas as pd
 import numpy as np
 import psycopg2 as pg2
 import pandas.io.sql as sqlio
-from sklearn.cluster import AgglomerativeClustering
-from sqlalchemy import create_engine
-import io
-
-def get_table(sql, db = 'xxx', user = 'postgres',host= 'localhost', port = '0000'):
-    conn = pg2.connect(dbname=db, user=user, host=host, port=port)
-    table = sqlio.read_sql_query(sql, conn)
-    conn = None
+import sys
+sys.path.append("..")
+from src.db import connection, get_engine
+from src.pg_copy import copy_dataframe
+from src.clustering import fit_clusters
+from src.features import PropertyFeatures, NUMERIC_COLS, DUMMY_COLS
+from src.metrics import timed
+
+CLUSTER_METHOD = 'ward' # see src/clustering.py; 'birch' or 'minibatch_kmeans' scale to large fleets
+
+@timed('get_table')
+def get_table(sql, db = 'xxx', user = 'postgres',host= 'localhost', port = '0000', params = None):
+    with connection(db, user, host, port) as conn:
+        table = sqlio.read_sql_query(sql, conn, params=params)
     return table
 
+def execute_sql(sql, params = None, db = 'xxx', user = 'postgres',host= 'localhost', port = '0000'):
+    '''
+    runs a statement that returns no rows (DELETE, CREATE INDEX, ...) and commits it
+    '''
+    with connection(db, user, host, port) as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+
 def push_table(df, table, db = 'xxx', user = 'postgres',
-               host= 'localhost', port = '0000'):
+               host= 'localhost', port = '0000', if_exists = 'replace',
+               chunksize = 100000, binary = False, atomic = False):
     '''
     inputs:
         df = dataframe to push
         table = table name to write in database
         db = database
         user, host, port = database connection info
+        if_exists = 'replace' to overwrite the table, 'append' to add rows to it
+        chunksize = rows encoded and sent at a time, bounds the memory used by the copy
+        binary = use Postgres binary COPY instead of CSV
+        atomic = (replace only) load into a staging table and swap it in with a rename,
+                 so readers see either the old table or the complete new one
     
     outputs:
-        writes table to DB. Overwrites if table already exists
+        writes table to DB. Overwrites if table already exists, unless if_exists = 'append'
     '''
-    engine = create_engine('postgresql+psycopg2://'+user+':@'+host+':'+port+'/'+db)
-    df.head(0).to_sql('property_clusters', engine, if_exists='replace',index=False) #truncates the table
+    engine = get_engine(db, user, host, port)
+    target = table
+    if atomic and if_exists == 'replace':
+        target = table + '__staging'
+    df.head(0).to_sql(target, engine, if_exists=if_exists,index=False) #truncates the table (creates it when appending)
     
     conn = engine.raw_connection()
-    cur = conn.cursor()
-    output = io.StringIO()
-    df.to_csv(output, sep='|', header=False, index=False)
-    output.seek(0)
-    contents = output.getvalue()
-    cur.copy_from(output, table, sep = '|', null="") # null values become ''
-    conn.commit()
+    try:
+        cur = conn.cursor()
+        copy_dataframe(cur, df, target, chunksize, binary)
+        if target != table:
+            cur.execute('''DROP TABLE IF EXISTS {0}__old;
+                           ALTER TABLE IF EXISTS {0} RENAME TO {0}__old;
+                           ALTER TABLE {1} RENAME TO {0};
+                           DROP TABLE IF EXISTS {0}__old;'''.format(table, target))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close() # returns the connection to the engine's pool
+
+def prepare_properties(props, mgmt_counts = None, drop_unmanaged = True):
+    '''
+    inputs:
+        props = property rows as selected below (currency_id, zip, management_company_id, ...)
+        mgmt_counts = (optional) properties per management_company_id; counted from props
+                      when not given. Pass the fleet-wide counts when preparing a few rows
+        drop_unmanaged = drop rows without a management company. When False they are
+                         kept, counted as managing only themselves
+
+    outputs:
+        props with the currency, zip zone and props_under_mgmt model columns
+    '''
+    if mgmt_counts is None:
+        mgmt_counts = props['management_company_id'].value_counts()
+    if drop_unmanaged:
+        props = props[props.management_company_id.notnull()]
+    props = props.copy()
+
+    ## Currency code => Currency
+    props['currency'] = np.where(props.currency_id == 1, 'USD', 'CAD')
+
+    ## Group locations into zones of first digit from zip
+    props['zip'] = np.where(props.zip.str.isnumeric(),props.zip.astype(str).str[0],'can')
+
+    ## Number of Properties Under Managment
+    props['props_under_mgmt'] = props.management_company_id.map(mgmt_counts).fillna(1).astype(int)
+    return props
 
 if __name__ == "__main__":
 
@@ -78,50 +136,29 @@ if __name__ == "__main__":
     # Feature Engineering
     print('creating features...')
 
-    ## Currency code => Currency
-    props['currency'] = np.where(props.currency_id == 1, 'USD', 'CAD')
+    props = prepare_properties(props)
 
-    ## Group locations into zones of first digit from zip
-    props.zip = np.where(props.zip.str.isnumeric(),props.zip.astype(str).str[0],'can')
-
-    ## Number of Properties Under Managment
-    mgmt = pd.DataFrame(props['management_company_id'].value_counts()).reset_index()
-    mgmt.rename(columns={'index':'management_company_id',
-                        'management_company_id':'props_under_mgmt'}, inplace=True)
-    props = props.merge(mgmt, on=('management_company_id'))
-
-    ## Selecting Columns
-    props_mod = props.copy()
-    index_col = ['property_id'] # column to use as index
-    numeric_cols = ['props_under_mgmt','rooms',
-                    #'alcohol_tax_rate', 'sales_tax_rate', 'tobacco_tax_rate'
-                ]
-    dummy_cols = ['kind','guest_profile','location_type',
-                'currency','flag_name','zip']
-    drop_cols = list(set(props.columns) - set(index_col) - set(numeric_cols))
-
-    props_mod = props_mod.merge(pd.get_dummies(data = props_mod,columns = dummy_cols,drop_first=True))
-
-    ## One-Hot Encoding
-    props_mod = props.copy() #initialize modeling df
-    index_col = ['property_id'] #saved as index of modeling df
-    numeric_cols = ['props_under_mgmt','rooms',
-                    #'alcohol_tax_rate', 'sales_tax_rate', 'tobacco_tax_rate' #these columns not well populated
-                ] #included numerical columns in model
-    dummy_cols = ['kind','guest_profile','location_type',
-                'currency','flag_name','zip'] #columns to one-hot encode
-    drop_cols = list(set(props.columns) - set(index_col) - set(numeric_cols)) #columns not used for model
-    props_mod = props_mod.merge(pd.get_dummies(data = props_mod,columns = dummy_cols,drop_first=True)) #create dummies
-    props_mod = props_mod.drop(drop_cols , axis = 1) #drop unused features
-    props_mod.index = props_mod.property_id #sets index by id
-    props_mod.drop(index_col, axis = 1 , inplace = True) #drop id columns since we don't want to model on it
+    ## Sparse matrix of scaled rooms / props_under_mgmt and one-hot kind, guest_profile,
+    ## location_type, currency, flag_name and zip zone (first level of each dropped)
+    encoder = PropertyFeatures(NUMERIC_COLS, DUMMY_COLS, drop_first=True, scale=True)
+    features = encoder.fit_transform(props)
 
     ## Clustering
     print('creating clusters...')
-    agg_ward = AgglomerativeClustering(n_clusters=6).fit_predict(props_mod) #define clusters
-    props['cluster'] = agg_ward # add cluster definition to original dataset
+    clusters = fit_clusters(features, CLUSTER_METHOD, n_clusters=6) #define clusters
+    props['cluster'] = clusters # add cluster definition to original dataset
+
+    ## Save Model so new properties can be assigned without re-clustering
+    from src.cluster_model import ClusterModel
+    model = ClusterModel.fit(props, encoder, features, clusters)
+    model.save()
+    print('saved cluster model {}'.format(model.version))
+
+    ## Peer Index for the similar hotels recommendations
+    from src.peer_index import PeerIndex
+    PeerIndex.build(props, model).save()
 
     ## Write Table to DB
     print('writing table to db...')
-    push_table(props, 'property_clusters')
+    push_table(props, 'property_clusters', atomic=True)
     print('complete.')
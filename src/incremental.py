@@ -0,0 +1,223 @@
+import argparse
+import sys
+sys.path.append("..")
+from src.db import connection
+from src.pg_copy import copy_dataframe
+from src.sql_recommender import STORE_COLS, CLUSTER_COLS, NATIONAL_COLS, SqlSales, ranked_sql, _param
+from src.batch_recommender import STALE_TABLE, STALE_TABLE_SQL
+from src.encoding import load_sales
+
+FACT_TABLE = 'product_category_recommender'
+TOP_N = 10 # deepest ranking the app asks for; a change below it doesn't make a recommendation stale
+
+# level -> (table, columns, unique key, ranking partition)
+LEVELS = {
+    'store': ('agg_store_sales', STORE_COLS, STORE_COLS,
+              ['property_code', 'category_name', 'transaction_month']),
+    'cluster': ('agg_cluster_sales', CLUSTER_COLS, CLUSTER_COLS,
+                ['cluster', 'category_name', 'transaction_month']),
+    'national': ('agg_national_sales', NATIONAL_COLS, NATIONAL_COLS,
+                 ['category_name', 'transaction_month']),
+    }
+
+
+def create_aggregate_tables(cur, fact_table = FACT_TABLE):
+    '''
+    creates the aggregate tables (column types copied from the fact table) and their keys
+    '''
+    for level, (table, cols, key, partition) in LEVELS.items():
+        cur.execute('''CREATE TABLE IF NOT EXISTS {0} AS
+                        SELECT {1}, CAST(SUM(number_sold) AS BIGINT) AS number_sold, CAST(NULL AS BIGINT) AS sales_rank
+                        FROM {2} GROUP BY {1} WITH NO DATA'''.format(table, ', '.join(cols), fact_table))
+        cur.execute('DROP INDEX IF EXISTS {0}_key'.format(table)) # the store key used to leave out cluster
+        cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS {0}_unique ON {0} ({1})'.format(table, ', '.join(key)))
+        cur.execute('CREATE INDEX IF NOT EXISTS {0}_rank ON {0} ({1}, sales_rank)'.format(table, ', '.join(partition)))
+    cur.execute(STALE_TABLE_SQL)
+
+def _rank(cur, level, affected):
+    '''
+    renumbers sales_rank in the partitions listed in temp table affected
+    '''
+    table, cols, key, partition = LEVELS[level]
+    part = ', '.join(partition)
+    join = ' AND '.join('a.{0} = r.{0}'.format(c) for c in key)
+    cur.execute('''UPDATE {0} a SET sales_rank = r.sales_rank
+                    FROM (SELECT {1}, ROW_NUMBER() OVER (PARTITION BY {2}
+                                                         ORDER BY number_sold DESC, description) AS sales_rank
+                          FROM {0}
+                          WHERE number_sold > 0 AND ({2}) IN (SELECT {2} FROM {3})) r
+                    WHERE {4}'''.format(table, ', '.join(key), part, affected, join))
+
+def _tops(cur, level, affected):
+    '''
+    top TOP_N (description, number_sold) of every affected partition, as partition -> list.
+    Stored recommendations show each product's share of the top, so a change in any
+    count makes them stale even when the order holds
+    '''
+    table, cols, key, partition = LEVELS[level]
+    part = ', '.join(partition)
+    cur.execute('''SELECT {0}, description, number_sold FROM {1}
+                    WHERE sales_rank <= %(top_n)s AND ({0}) IN (SELECT {0} FROM {2})
+                    ORDER BY {0}, sales_rank'''.format(part, table, affected), {'top_n': TOP_N})
+    tops = {}
+    for row in cur.fetchall():
+        tops.setdefault(row[:-2], []).append(tuple(row[-2:]))
+    return tops
+
+def _changed(before, after):
+    return [p for p in set(before) | set(after) if before.get(p) != after.get(p)]
+
+def apply_delta(rows, db = 'xxx', user = 'postgres', host = 'localhost', port = '0000'):
+    '''
+    inputs:
+        rows = every fact row of the (property_code, transaction_month) pairs that were
+               loaded or reloaded, e.g. one day's refresh of the current month. They
+               replace whatever those pairs contributed to the aggregates before
+
+    outputs:
+        dict of how many partitions were re-ranked and recommendations marked stale
+
+    The store aggregates of the pairs are swapped for the new ones, and the cluster and
+    national aggregates move by the difference, so the cost follows the size of the delta
+    rather than the history. Only partitions the delta touches are re-ranked. Precomputed
+    recommendations are marked stale where the property's own sales changed, where the
+    products or counts of its cluster's top TOP_N changed, or (for every property) where
+    the national top TOP_N's did. Everything runs in one transaction.
+    '''
+    new = rows[rows.number_sold > 0].groupby(STORE_COLS, observed=True)[['number_sold']].sum().reset_index()
+    pairs = rows[['property_code', 'transaction_month']].drop_duplicates()
+    store = LEVELS['store'][0]
+    stats = {}
+
+    with connection(db, user, host, port) as conn:
+        cur = conn.cursor()
+        create_aggregate_tables(cur)
+
+        cur.execute('CREATE TEMP TABLE delta_pairs ON COMMIT DROP AS SELECT property_code, transaction_month FROM {} WITH NO DATA'.format(store))
+        copy_dataframe(cur, pairs.astype(object), 'delta_pairs')
+        cur.execute('CREATE TEMP TABLE store_new ON COMMIT DROP AS SELECT {} FROM {} WITH NO DATA'.format(
+            ', '.join(STORE_COLS + ['number_sold']), store))
+        copy_dataframe(cur, new.astype({c: object for c in new.columns if str(new[c].dtype) == 'category'}), 'store_new')
+        cur.execute('''CREATE TEMP TABLE store_old ON COMMIT DROP AS
+                        SELECT {} FROM {} JOIN delta_pairs USING (property_code, transaction_month)'''.format(
+                            ', '.join(STORE_COLS + ['number_sold']), store))
+
+        # what the cluster and national totals move by
+        for level, cols in [('cluster', CLUSTER_COLS), ('national', NATIONAL_COLS)]:
+            c = ', '.join(cols)
+            cur.execute('''CREATE TEMP TABLE {0}_diff ON COMMIT DROP AS
+                            SELECT {1}, CAST(SUM(number_sold) AS BIGINT) AS number_sold
+                            FROM (SELECT {1}, number_sold FROM store_new
+                                  UNION ALL SELECT {1}, -number_sold FROM store_old) d
+                            GROUP BY {1} HAVING SUM(number_sold) <> 0'''.format(level, c))
+        for level in LEVELS:
+            part = ', '.join(LEVELS[level][3])
+            source = 'store_new UNION SELECT {} FROM store_old'.format(part) if level == 'store' else level + '_diff'
+            cur.execute('CREATE TEMP TABLE {0}_affected ON COMMIT DROP AS SELECT DISTINCT {1} FROM {2}'.format(
+                level, part, source))
+        before = {level: _tops(cur, level, level + '_affected') for level in ['cluster', 'national']}
+
+        cur.execute('DELETE FROM {} a USING delta_pairs d WHERE a.property_code = d.property_code AND a.transaction_month = d.transaction_month'.format(store))
+        cur.execute('INSERT INTO {0} ({1}, number_sold) SELECT {1}, number_sold FROM store_new'.format(
+            store, ', '.join(STORE_COLS)))
+        for level in ['cluster', 'national']:
+            table, cols, key, partition = LEVELS[level]
+            c = ', '.join(cols)
+            cur.execute('''INSERT INTO {0} ({1}, number_sold) SELECT {1}, number_sold FROM {2}_diff
+                            ON CONFLICT ({3}) DO UPDATE SET number_sold = {0}.number_sold + EXCLUDED.number_sold'''.format(
+                                table, c, level, ', '.join(key)))
+            cur.execute('DELETE FROM {0} a USING {1}_diff d WHERE {2} AND a.number_sold <= 0'.format(
+                table, level, ' AND '.join('a.{0} = d.{0}'.format(k) for k in key)))
+
+        for level in LEVELS:
+            _rank(cur, level, level + '_affected')
+            cur.execute('SELECT COUNT(*) FROM {}_affected'.format(level))
+            stats[level + '_partitions'] = cur.fetchone()[0]
+        after = {level: _tops(cur, level, level + '_affected') for level in ['cluster', 'national']}
+
+        # stale: the properties in the delta, every property of a cluster whose top changed,
+        # and every property (property_code NULL) where the national top changed
+        cur.execute('''INSERT INTO {} (transaction_month, category_name, property_code)
+                        SELECT transaction_month, category_name, property_code FROM store_affected'''.format(STALE_TABLE))
+        marked = cur.rowcount
+        for clust, category, month in _changed(before['cluster'], after['cluster']):
+            cur.execute('''INSERT INTO {} (transaction_month, category_name, property_code)
+                            SELECT DISTINCT transaction_month, %(category)s, property_code FROM {}
+                            WHERE cluster = %(cluster)s AND transaction_month = %(month)s'''.format(
+                                STALE_TABLE, store),
+                        {'category': category, 'cluster': clust, 'month': month})
+            marked += cur.rowcount
+        national_changed = _changed(before['national'], after['national'])
+        for category, month in national_changed:
+            cur.execute('INSERT INTO {} (transaction_month, category_name, property_code) VALUES (%(month)s, %(category)s, NULL)'.format(STALE_TABLE),
+                        {'category': category, 'month': month})
+        stats['stale_recommendations'] = marked
+        stats['stale_categories'] = len(national_changed)
+    return stats
+
+class AggregateSales(SqlSales):
+    '''
+    SqlSales reading the aggregate tables kept up to date by apply_delta instead of
+    grouping the fact table: each lookup is an index read of one partition, and the
+    cluster and national top products come straight from the stored sales_rank
+    '''
+
+    def __init__(self, read = None, paramstyle = 'pyformat'):
+        SqlSales.__init__(self, read, LEVELS['store'][0], paramstyle)
+
+    def _sql(self, group_cols, keys, filters, num = None, with_pct = False, where = ()):
+        return ranked_sql(group_cols, keys, filters, num, with_pct, LEVELS['store'][0], self.paramstyle, where)
+
+    def _properties_sql(self, in_codes):
+        # the aggregate tables don't carry the property's description
+        return '''SELECT c.property_code, c.cluster, l.flag_name, l.city, l.state
+                    FROM (SELECT property_code, MAX(cluster) AS cluster FROM {} WHERE {}
+                          GROUP BY property_code) c
+                    LEFT JOIN property_code_lookup l ON l.property_code = c.property_code'''.format(
+                        LEVELS['store'][0], in_codes)
+
+    def _top(self, level, params):
+        table, cols, key, partition = LEVELS[level]
+        where = ' AND '.join('{} = {}'.format(c, _param(c, self.paramstyle)) for c in partition)
+        sql = '''SELECT {}, number_sold FROM {}
+                    WHERE {} AND sales_rank <= {}
+                    ORDER BY sales_rank'''.format(', '.join(cols), table, where, _param('num', self.paramstyle))
+        return self.read(sql, params)
+
+    def top_sold_by_cluster(self, cluster, category, month, num):
+        return self._top('cluster', {'cluster': cluster, 'category_name': category,
+                                     'transaction_month': month, 'num': num})
+
+    def top_sold_overall(self, category, month, num):
+        return self._top('national', {'category_name': category, 'transaction_month': month, 'num': num})
+
+    def describe(self, property_code):
+        sql = 'SELECT flag_name, city, state FROM property_code_lookup WHERE property_code = {}'.format(
+            _param('property_code', self.paramstyle))
+        return self.read(sql, {'property_code': property_code}).iloc[0]
+
+def rebuild_month(month, fact_table = FACT_TABLE):
+    '''
+    (re)builds the aggregates of one month from the fact table, e.g. to seed the tables
+    '''
+    sold = load_sales('SELECT * FROM {} WHERE transaction_month = %(month)s'.format(fact_table),
+                      params={'month': month})
+    return apply_delta(sold)
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='fold new or reloaded sales rows into the aggregate tables')
+    parser.add_argument('month', help='transaction_month the rows belong to')
+    parser.add_argument('--properties', nargs='+', default=None,
+                        help='only the properties whose rows were (re)loaded, all of the month by default')
+    args = parser.parse_args()
+
+    sql = 'SELECT * FROM {} WHERE transaction_month = %(month)s'.format(FACT_TABLE)
+    params = {'month': args.month}
+    if args.properties:
+        sql += ' AND property_code IN %(properties)s'
+        params['properties'] = tuple(args.properties)
+    print('reading delta...')
+    rows = load_sales(sql, params=params)
+    print('applying {} rows...'.format(rows.shape[0]))
+    print(apply_delta(rows))
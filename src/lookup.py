@@ -0,0 +1,72 @@
+import sys
+sys.path.append("..")
+from src.get_clusters import get_table
+
+PAGE_SIZE = 50
+
+# table -> (columns a page may be sorted by, columns a page may be filtered on, default sort)
+LOOKUPS = {
+    'property_code_lookup': (['property_code', 'flag_name', 'city', 'state'],
+                             ['flag_name', 'city', 'state'],
+                             ['property_code']),
+    'product_category_xref': (['category_name', 'description'],
+                              ['category_name'],
+                              ['category_name', 'description']),
+    }
+
+
+def lookup_sql(table, filters = None, sort = None, descending = False, page = 1, page_size = PAGE_SIZE):
+    '''
+    inputs:
+        table = one of the LOOKUPS tables
+        filters = dict of column -> value, None or empty values are ignored
+        sort = column to sort by, must be one of the table's sort columns
+        descending = sort direction
+        page = 1 based page number
+        page_size = rows per page
+
+    outputs:
+        (SQL, bind parameters) reading page_size + 1 rows
+
+    Sorting and filtering run in Postgres with bound parameters, and one extra row is
+    read past the page to tell whether another page exists without counting the table.
+    '''
+    sort_cols, filter_cols, default_sort = LOOKUPS[table]
+    if sort is not None and sort not in sort_cols:
+        raise ValueError('cannot sort {} by {}'.format(table, sort))
+    # the default sort columns break ties so pages don't overlap
+    order = [sort] + [c for c in default_sort if c != sort] if sort else default_sort
+    direction = ' DESC' if descending else ''
+
+    where, params = [], {}
+    for col, value in (filters or {}).items():
+        if col not in filter_cols:
+            raise ValueError('cannot filter {} on {}'.format(table, col))
+        if value:
+            where.append('{0} = %({0})s'.format(col))
+            params[col] = value
+
+    page = max(int(page), 1)
+    params['limit'] = page_size + 1
+    params['offset'] = (page - 1) * page_size
+    sql = '''SELECT *
+                FROM {}
+                {}
+                ORDER BY {}
+                LIMIT %(limit)s OFFSET %(offset)s'''.format(table,
+                                                            'WHERE ' + ' AND '.join(where) if where else '',
+                                                            ', '.join(c + direction for c in order))
+    return sql, params
+
+def split_page(rows, page_size = PAGE_SIZE):
+    '''
+    (DataFrame with at most page_size rows, True if there is a next page)
+    '''
+    return rows.head(page_size), rows.shape[0] > page_size
+
+def lookup_page(table, filters = None, sort = None, descending = False, page = 1, page_size = PAGE_SIZE):
+    '''
+    reads one page of lookup_sql, see split_page for the output
+    '''
+    sql, params = lookup_sql(table, filters, sort, descending, page, page_size)
+    return split_page(get_table(sql, params=params), page_size)
@@ -0,0 +1,113 @@
+import time
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# histogram bucket upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float('inf'))
+
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+        self.sum += seconds
+        self.count += 1
+
+
+class Registry(object):
+    '''
+    Timing histograms keyed by (metric, route, stage), rendered in Prometheus text format
+    '''
+
+    def __init__(self):
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, metric, seconds, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self._histograms:
+                self._histograms[key] = Histogram()
+            self._histograms[key].observe(seconds)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for metric in sorted({m for m, _ in self._histograms}):
+                lines.append('# TYPE {} histogram'.format(metric))
+                for (m, labels), hist in sorted(self._histograms.items()):
+                    if m != metric:
+                        continue
+                    label_str = ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels)
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, hist.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else repr(bound)
+                        lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(metric, label_str,
+                                                                          ',' if label_str else '', le, cumulative))
+                    lines.append('{}_sum{{{}}} {}'.format(metric, label_str, hist.sum))
+                    lines.append('{}_count{{{}}} {}'.format(metric, label_str, hist.count))
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+# context variables rather than thread locals: one context per thread under Flask, one per
+# task under the async app, copied into executor threads by async_app.run_sync
+_route = contextvars.ContextVar('route', default=None)
+_stages = contextvars.ContextVar('stages', default=None)
+_start = contextvars.ContextVar('start', default=None)
+
+
+def start_request(route):
+    '''
+    marks the start of a request in this context; stages timed until end_request are
+    labeled with route and kept for the slow request log
+    '''
+    _route.set(route)
+    _stages.set([])
+    _start.set(time.perf_counter())
+
+def end_request():
+    '''
+    outputs:
+        (request seconds, list of (stage, seconds) timed during the request)
+    '''
+    start = _start.get()
+    seconds = time.perf_counter() - start if start is not None else 0.0
+    REGISTRY.observe('recommender_request_seconds', seconds, route=current_route())
+    stages = _stages.get() or []
+    _route.set(None)
+    _stages.set(None)
+    _start.set(None)
+    return seconds, stages
+
+def current_route():
+    return _route.get() or 'none'
+
+@contextmanager
+def timed(stage):
+    '''
+    times the block (or, used as @timed('stage'), every call of the function) into the
+    recommender_stage_seconds histogram for the current route. Nested stages are each
+    timed in full, so a stage's time includes the stages inside it
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        REGISTRY.observe('recommender_stage_seconds', seconds, route=current_route(), stage=stage)
+        stages = _stages.get()
+        if stages is not None:
+            stages.append((stage, seconds))
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,102 @@
+import time
+import threading
+from collections import OrderedDict
+
+
+class MonthCache(object):
+    '''
+    Bounded in-process cache of month slices of product_category_recommender
+
+    Inputs:
+        loader = function(month) returning the DataFrame for that transaction_month
+        max_bytes = total memory the cached frames may use before the least
+                    recently used month is evicted
+        ttl = seconds a cached month is served before it is reloaded
+        latest_loader = (optional) function() returning the newest transaction_month
+                        in the database; checked at most every check_interval seconds
+        check_interval = seconds between latest_loader checks
+
+    When a new month shows up, the month that used to be the newest is dropped since it
+    was most likely still being filled in when it was cached.
+
+    Methods:
+        get(month) : cached DataFrame for the month, loading it on a miss
+        invalidate(month) : drops one month, or everything if month is None
+        sync_latest(latest) : tells the cache which month is the newest
+        stats() : hit / miss / eviction counters and current size
+    '''
+
+    def __init__(self, loader, max_bytes = 1 << 30, ttl = 3600,
+                 latest_loader = None, check_interval = 300):
+        self.loader = loader
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.latest_loader = latest_loader
+        self.check_interval = check_interval
+        self._entries = OrderedDict() # month -> (df, nbytes, loaded_at)
+        self._bytes = 0
+        self._latest = None
+        self._last_check = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, month):
+        if self.latest_loader is not None and time.time() - self._last_check > self.check_interval:
+            self._last_check = time.time()
+            self.sync_latest(self.latest_loader())
+
+        with self._lock:
+            entry = self._entries.get(month)
+            if entry is not None and time.time() - entry[2] < self.ttl:
+                self._entries.move_to_end(month)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        # load outside the lock so a slow query doesn't block hits on other months
+        df = self.loader(month)
+        nbytes = int(df.memory_usage(deep=True).sum())
+
+        with self._lock:
+            self._drop(month)
+            if nbytes <= self.max_bytes:
+                self._entries[month] = (df, nbytes, time.time())
+                self._bytes += nbytes
+                while self._bytes > self.max_bytes:
+                    self._drop(next(iter(self._entries)))
+                    self.evictions += 1
+        return df
+
+    def _drop(self, month):
+        entry = self._entries.pop(month, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+
+    def invalidate(self, month = None):
+        with self._lock:
+            if month is None:
+                self._entries.clear()
+                self._bytes = 0
+            else:
+                self._drop(month)
+            self.invalidations += 1
+
+    def sync_latest(self, latest):
+        with self._lock:
+            if self._latest is not None and latest != self._latest:
+                self._drop(self._latest)
+                self.invalidations += 1
+            self._latest = latest
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'months': list(self._entries),
+                    'bytes': self._bytes,
+                    'max_bytes': self.max_bytes}
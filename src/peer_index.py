@@ -0,0 +1,158 @@
+import os
+import time
+import pickle
+import threading
+import numpy as np
+from sklearn.neighbors import BallTree
+import sys
+sys.path.append("..")
+from src.get_clusters import get_table
+from src.cluster_model import MODEL_DIR, latest_model
+
+LATEST = 'peer_index_latest.txt'
+CHECK_INTERVAL = 60 # seconds between checks of LATEST for a newer index
+PROPERTY_SQL = 'SELECT * FROM property_clusters WHERE property_code = %(property_code)s'
+
+
+class PeerIndex(object):
+    '''
+    Nearest neighbour index of properties in the clustering feature space
+
+    Inputs:
+        codes = property_code of every row of X
+        X = dense (n_properties x n_features) feature matrix, encoded by the ClusterModel
+        model = ClusterModel whose encoder built X, used to place properties not in the index
+        leaf_size = BallTree leaf size
+
+    The vectors are held in a BallTree, so a peer lookup costs O(log n_properties) distance
+    computations instead of one per property in the fleet. A BallTree rather than a KDTree
+    because the one-hot columns make the space high dimensional.
+
+    Methods:
+        build(props, model) : index over prepared property rows (e.g. property_clusters)
+        peers(property_code, k) : the k properties closest to property_code
+        peers_of_row(property_row, k) : the k properties closest to a property not in the index
+        save(path) / load(path, version) : versioned pickles under models/, next to the ClusterModel
+
+    Attributes:
+        codes_ : property_code of every indexed row
+        version : version of the ClusterModel the index was built from
+    '''
+
+    def __init__(self, codes, X, model, leaf_size = 40):
+        self.codes_ = np.asarray(codes, dtype=object) # plain str codes, so they bind as query parameters
+        self.model = model
+        self.version = model.version
+        self._X = np.asarray(X, dtype=float)
+        self._tree = BallTree(self._X, leaf_size=leaf_size)
+        self._pos = {code: i for i, code in enumerate(self.codes_)}
+
+    @classmethod
+    def build(cls, props, model):
+        '''
+        inputs:
+            props = prepared property rows (see prepare_properties) with property_code
+            model = ClusterModel whose encoder the clusters were fit with
+        '''
+        return cls(props.property_code.values, model.encoder.transform(props).toarray(), model)
+
+    def _query(self, x, k, exclude = None):
+        # one extra neighbour so the property itself can be dropped, wherever it ranks among ties
+        rows = self._tree.query(x.reshape(1, -1), k=min(k + 1, len(self.codes_)), return_distance=False)[0]
+        return [self.codes_[i] for i in rows if self.codes_[i] != exclude][:k]
+
+    def peers(self, property_code, k = 10):
+        '''
+        outputs:
+            list of up to k property_codes, nearest first. KeyError if property_code isn't indexed
+        '''
+        return self._query(self._X[self._pos[property_code]], k, property_code)
+
+    def peers_of_row(self, property_row, k = 10):
+        '''
+        inputs:
+            property_row = dict / Series with the columns selected in get_clusters
+        '''
+        return self._query(self.model.features(property_row), k, property_row.get('property_code'))
+
+    def save(self, path = MODEL_DIR):
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'peer_index_{}.pkl'.format(self.version)), 'wb') as f:
+            pickle.dump(self, f)
+        with open(os.path.join(path, LATEST), 'w') as f:
+            f.write(self.version)
+
+    @classmethod
+    def load(cls, path = MODEL_DIR, version = None):
+        if version is None:
+            with open(os.path.join(path, LATEST)) as f:
+                version = f.read().strip()
+        with open(os.path.join(path, 'peer_index_{}.pkl'.format(version)), 'rb') as f:
+            return pickle.load(f)
+
+_peer_index = None
+_peer_index_checked = 0
+_peer_index_lock = threading.Lock()
+
+def latest_peer_index(path = MODEL_DIR, check_interval = CHECK_INTERVAL):
+    '''
+    latest saved PeerIndex. LATEST is re-read at most every check_interval seconds and a
+    new version loaded when it changes. FileNotFoundError while none has been built,
+    which is remembered for check_interval too, so requests don't reopen LATEST each time
+    '''
+    global _peer_index, _peer_index_checked
+    with _peer_index_lock:
+        if time.time() - _peer_index_checked >= check_interval:
+            _peer_index_checked = time.time()
+            try:
+                with open(os.path.join(path, LATEST)) as f:
+                    version = f.read().strip()
+            except FileNotFoundError:
+                version = None
+            if version is None:
+                _peer_index = None
+            elif _peer_index is None or _peer_index.version != version:
+                _peer_index = PeerIndex.load(path, version)
+        index = _peer_index
+    if index is None:
+        raise FileNotFoundError('no peer index saved in {}'.format(path))
+    return index
+
+def similar_properties(property_code, k = 10, index = None, read = None):
+    '''
+    inputs:
+        property_code
+        k = number of peers
+        index = (optional) PeerIndex, defaults to the latest saved one
+        read = (optional) function(sql, params) returning a DataFrame, defaults to get_table
+
+    outputs:
+        the k properties most similar to property_code, nearest first. A property added
+        since the index was built (see cluster_model.onboard_property) is placed from its
+        property_clusters row. KeyError if it has none
+    '''
+    index = index or latest_peer_index()
+    try:
+        return index.peers(property_code, k)
+    except KeyError:
+        read = read or (lambda sql, params: get_table(sql, params=params))
+        rows = read(PROPERTY_SQL, {'property_code': property_code})
+        if rows.shape[0] == 0:
+            raise
+        return index.peers_of_row(rows.iloc[0], k)
+
+if __name__ == "__main__":
+
+    print('getting data...')
+    model = latest_model()
+    props = get_table('SELECT * FROM property_clusters')
+
+    print('indexing {} properties...'.format(props.shape[0]))
+    index = PeerIndex.build(props, model)
+    index.save()
+
+    start = time.time()
+    for code in props.property_code.values[:1000]:
+        index.peers(code)
+    print('saved peer index {}, {:.3f} ms per lookup'.format(
+        index.version, 1000 * (time.time() - start) / max(min(props.shape[0], 1000), 1)))
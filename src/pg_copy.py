@@ -0,0 +1,125 @@
+import io
+import struct
+import pandas as pd
+
+PG_EPOCH = pd.Timestamp('2000-01-01')
+BINARY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+BINARY_TRAILER = struct.pack('!h', -1)
+NULL_FIELD = struct.pack('!i', -1)
+
+
+class _ChunkStream(object):
+    '''
+    file-like object that encodes df chunksize rows at a time as copy_expert reads it,
+    so at most one encoded chunk is held in memory
+    '''
+
+    def __init__(self, df, chunksize, header = None, trailer = None):
+        self._chunks = (df.iloc[i:i + chunksize] for i in range(0, df.shape[0], chunksize))
+        self._pending = [header] if header is not None else []
+        self._trailer = trailer
+        self._buf = self._empty
+        self._pos = 0
+
+    def _next_buffer(self):
+        if self._pending:
+            return self._pending.pop()
+        chunk = next(self._chunks, None)
+        if chunk is not None:
+            return self._encode(chunk)
+        if self._trailer is not None:
+            trailer, self._trailer = self._trailer, None
+            return trailer
+        return None
+
+    def read(self, size = -1):
+        parts = []
+        while size < 0 or size > 0:
+            if self._pos >= len(self._buf):
+                buf = self._next_buffer()
+                if buf is None:
+                    break
+                self._buf, self._pos = buf, 0
+                continue
+            stop = len(self._buf) if size < 0 else min(len(self._buf), self._pos + size)
+            parts.append(self._buf[self._pos:stop])
+            if size > 0:
+                size -= stop - self._pos
+            self._pos = stop
+        return self._empty.join(parts)
+
+
+class CsvStream(_ChunkStream):
+    '''
+    CSV ('|' separated, empty = NULL) matching COPY ... WITH (FORMAT csv, DELIMITER '|', NULL '')
+    '''
+    _empty = ''
+
+    def _encode(self, chunk):
+        return chunk.to_csv(sep='|', header=False, index=False)
+
+
+def _field_encoder(col):
+    '''
+    binary encoder for a column, matching the type pandas.to_sql created for it
+    '''
+    values, dtype = col, col.dtype
+    if isinstance(dtype, pd.CategoricalDtype):
+        values, dtype = dtype.categories, dtype.categories.dtype
+    if pd.api.types.is_bool_dtype(dtype):
+        return lambda v: b'\x01' if v else b'\x00'
+    if pd.api.types.is_integer_dtype(dtype):
+        if dtype.itemsize <= 2 or dtype.name == 'uint8':
+            return lambda v: struct.pack('!h', v) # SMALLINT
+        if dtype.name in ('int32', 'uint16'):
+            return lambda v: struct.pack('!i', v) # INTEGER
+        return lambda v: struct.pack('!q', v) # BIGINT
+    if pd.api.types.is_float_dtype(dtype):
+        if dtype.itemsize == 4:
+            return lambda v: struct.pack('!f', v) # REAL
+        return lambda v: struct.pack('!d', v) # DOUBLE PRECISION
+    if pd.api.types.is_datetime64_dtype(dtype):
+        return lambda v: struct.pack('!q', (pd.Timestamp(v) - PG_EPOCH) // pd.Timedelta(microseconds=1)) # TIMESTAMP
+    if pd.api.types.infer_dtype(values, skipna=True) in ('string', 'empty'):
+        return lambda v: v.encode('utf-8') # TEXT
+    raise ValueError('binary COPY does not support column {} ({}), use binary=False'.format(col.name, col.dtype))
+
+
+class BinaryStream(_ChunkStream):
+    '''
+    Postgres binary COPY format, matching COPY ... WITH (FORMAT binary)
+    '''
+    _empty = b''
+
+    def __init__(self, df, chunksize):
+        self._encoders = [_field_encoder(df[c]) for c in df.columns]
+        self._nfields = struct.pack('!h', df.shape[1])
+        super(BinaryStream, self).__init__(df, chunksize, BINARY_HEADER, BINARY_TRAILER)
+
+    def _encode(self, chunk):
+        out = io.BytesIO()
+        columns = [chunk[c].astype(object).where(chunk[c].notnull(), None).tolist() for c in chunk.columns]
+        for row in zip(*columns):
+            out.write(self._nfields)
+            for value, encode in zip(row, self._encoders):
+                if value is None:
+                    out.write(NULL_FIELD)
+                else:
+                    field = encode(value)
+                    out.write(struct.pack('!i', len(field)))
+                    out.write(field)
+        return out.getvalue()
+
+
+def copy_dataframe(cur, df, table, chunksize = 100000, binary = False):
+    '''
+    streams df into table with COPY ... FROM STDIN, chunksize rows encoded at a time
+    '''
+    cols = ', '.join('"{}"'.format(c) for c in df.columns)
+    if binary:
+        sql = 'COPY {} ({}) FROM STDIN WITH (FORMAT binary)'.format(table, cols)
+        stream = BinaryStream(df, chunksize)
+    else:
+        sql = "COPY {} ({}) FROM STDIN WITH (FORMAT csv, DELIMITER '|', NULL '')".format(table, cols)
+        stream = CsvStream(df, chunksize)
+    cur.copy_expert(sql, stream, size=1 << 20)
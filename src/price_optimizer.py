@@ -4,6 +4,11 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from scipy.interpolate import CubicSpline, UnivariateSpline, interp1d
 from scipy import interpolate, stats
+import argparse
+import sys
+sys.path.append("..")
+from src.get_clusters import push_table
+from src.metrics import timed
 
 class prod_subset(object):
     '''
@@ -20,9 +25,9 @@ class prod_subset(object):
     Methods:
         return_df() : returns a DataFrame of the subsetted data
         optimiz_price() : naively assumes a uniform distribution and finds the max revenue
-        scatplot() :  plots a scatter plot of number sold and revenue as a function of price
-        boxplot() :  plots a box plot of number sold and revenue as a function of price
-        dists() : plots the distribution of price, number sold, and revenue
+        scatplot(path) :  plots a scatter plot of number sold and revenue as a function of price
+        boxplot(path) :  plots a box plot of number sold and revenue as a function of price
+        dists(path) : plots the distribution of price, number sold, and revenue
         
     Attributes:
         best_price_ : estimated best price to set on an item to maximize profits
@@ -30,6 +35,7 @@ class prod_subset(object):
         best_sales_ : the estimated median number of sales when using the best price
     '''
     
+    @timed('prod_subset')
     def __init__(self, df, description, month = None, cluster = None):
         self.df = df
         self.description = description
@@ -40,7 +46,7 @@ class prod_subset(object):
             self.data = self.data[self.data.cluster == self.cluster]
         if month:
             self.data = self.data[self.data.transaction_month == self.month]
-        self.data = self.data.groupby('unit_price').mean()[['number_sold']].reset_index()
+        self.data = self.data.groupby('unit_price')[['number_sold']].mean().reset_index()
         self.data['revenue'] = self.data.unit_price * self.data.number_sold
         self.best_price_, self.best_rev_, self.best_sales_ = self.optimize_price()
         
@@ -64,11 +70,14 @@ class prod_subset(object):
             mn = round(min(x))
             mx = np.ceil(max(x))
             rng = mx - mn
-            price_bins = np.linspace(mn,mx,(rng * 4) +1)
+            price_bins = np.linspace(mn,mx,int(rng * 4) +1) # the count must be an int on numpy >= 1.18
             bin_x = np.digitize(x, price_bins, right=True)
             mean,std= stats.norm.fit(bin_x)
             y_fit = stats.norm.pdf(bin_x, mean, std)
-            best_price = price_bins[np.unique(bin_x)][bin_x[np.argmax(y_fit)]]
+            unique_prices = price_bins[np.unique(bin_x)]
+            best_bin = bin_x[np.argmax(y_fit)]
+            # NaN where the lookup falls off the end, as in optimize_prices
+            best_price = unique_prices[best_bin] if best_bin < len(unique_prices) else np.nan
             if np.max(stats.binned_statistic(x, y1, statistic='median')[0]):
                 max_rev = np.max(stats.binned_statistic(x, y1, statistic='median')[0])
             else:
@@ -79,7 +88,7 @@ class prod_subset(object):
                 max_sales = np.median(y0[bin_x == bin_x[np.argmax(y_fit)]])
             return best_price, max_rev, max_sales
     
-    def scatplot(self):
+    def scatplot(self, path = 'static/sales_scatter.png'):
         '''
         returns number sold and revenue as a function of price
         '''
@@ -116,9 +125,10 @@ class prod_subset(object):
         else:
             clust_descrip = ''
         plt.suptitle(self.description + clust_descrip)
-        fig.savefig('static/sales_scatter.png')
+        fig.savefig(path)
+        plt.close(fig)
     
-    def boxplots(self):
+    def boxplots(self, path = 'static/sales_boxplot.png'):
         '''
         plots a box plot of number sold and revenue as a function of price
         '''
@@ -132,7 +142,7 @@ class prod_subset(object):
             mn = round(min(x))
             mx = np.ceil(max(x))
             rng = mx - mn
-            price_bins = np.linspace(mn,mx,(rng * 4) +1)
+            price_bins = np.linspace(mn,mx,int(rng * 4) +1) # the count must be an int on numpy >= 1.18
             bin_x = np.digitize(x, price_bins, right=True)
             mean,std= stats.norm.fit(bin_x)
             y_fit = stats.norm.pdf(bin_x, mean, std)
@@ -164,9 +174,10 @@ class prod_subset(object):
             else:
                 clust_descrip = ''
             plt.suptitle(self.description + clust_descrip)
-            fig.savefig('static/sales_boxplot.png')
+            fig.savefig(path)
+            plt.close(fig)
     
-    def dists(self):
+    def dists(self, path = 'static/sales_distributions.png'):
         '''
         plots the distribution of price, number sold, and revenue
         '''
@@ -186,5 +197,91 @@ class prod_subset(object):
             else:
                 clust_descrip = ''
             plt.suptitle('Distributions for ' + self.description + clust_descrip)
-            fig.savefig('static/sales_distributions.png')
-          
\ No newline at end of file
+            fig.savefig(path)
+            plt.close(fig)
+          
+
+
+def optimize_prices(df, by = ('description',)):
+    '''
+    batch version of prod_subset.optimize_price for every group of df at once
+
+    inputs:
+        df = DataFrame containing sales data with a unit_price column
+        by = columns that define one product, e.g. ('description', 'cluster', 'transaction_month')
+             for per cluster and month prices
+
+    outputs:
+        DataFrame with one row per group: best_price, best_rev, best_sales and
+        n_prices (distinct unit prices). Groups with fewer than 2 prices are left out,
+        like prod_subset. best_price is NaN where prod_subset's bin lookup falls off the
+        end of its array
+    '''
+    by = list(by)
+
+    # average number sold per unit price, as prod_subset.data
+    data = df.groupby(by + ['unit_price'], observed=True)['number_sold'].mean().reset_index()
+    data['revenue'] = data.unit_price * data.number_sold
+    data = data[data.groupby(by, observed=True).unit_price.transform('size') >= 2].reset_index(drop=True)
+    grp = data.groupby(by, observed=True, sort=False)
+
+    # quarter dollar bins from round(min) to ceil(max), np.digitize(..., right=True)
+    lo = grp.unit_price.transform('min')
+    hi = grp.unit_price.transform('max')
+    mn = np.round(lo)
+    data['bin_x'] = np.ceil((data.unit_price - mn) * 4).clip(lower=0).astype(int)
+
+    # the normal fit's pdf peaks at the first row whose bin is closest to the mean bin
+    data['dist'] = (data.bin_x - grp.bin_x.transform('mean')).abs()
+    best = data.loc[data.groupby(by, observed=True, sort=False).dist.idxmin(), by + ['bin_x']]
+    best = best.rename(columns={'bin_x': 'best_bin'})
+
+    # price_bins[np.unique(bin_x)][bin_x[argmax]]
+    unique_bins = data[by + ['bin_x']].drop_duplicates().sort_values(by + ['bin_x'])
+    unique_bins['best_bin'] = unique_bins.groupby(by, observed=True).cumcount()
+    best = best.merge(unique_bins.rename(columns={'bin_x': 'price_bin'}), on=by + ['best_bin'], how='left')
+    best = best.merge(data[by].assign(mn=mn).drop_duplicates(by), on=by)
+    best['best_price'] = best.mn + 0.25 * best.price_bin
+
+    # stats.binned_statistic(x, y, 'median'): 10 equal bins over [min, max]; np.max of the
+    # medians is NaN if any bin is empty
+    data['stat_bin'] = np.floor((data.unit_price - lo) / (hi - lo) * 10).clip(upper=9)
+    medians = data.groupby(by + ['stat_bin'], observed=True)[['revenue', 'number_sold']].median()
+    peaks = medians.groupby(by, observed=True).max()
+    peaks[medians.groupby(by, observed=True).size() < 10] = np.nan
+    best = best.merge(peaks.rename(columns={'revenue': 'best_rev', 'number_sold': 'best_sales'}).reset_index(),
+                      on=by)
+
+    # a peak median of 0 falls back to the median within the best price bin
+    at_best = data.merge(best[by + ['best_bin']], on=by)
+    at_best = at_best[at_best.bin_x == at_best.best_bin].groupby(by, observed=True)[['revenue', 'number_sold']]. \
+        median().reset_index().rename(columns={'revenue': 'fallback_rev', 'number_sold': 'fallback_sales'})
+    best = best.merge(at_best, on=by, how='left')
+    best['best_rev'] = np.where(best.best_rev == 0, best.fallback_rev, best.best_rev)
+    best['best_sales'] = np.where(best.best_sales == 0, best.fallback_sales, best.best_sales)
+
+    best = best.merge(grp.size().rename('n_prices').reset_index(), on=by)
+    return best[by + ['best_price', 'best_rev', 'best_sales', 'n_prices']]
+
+if __name__ == "__main__":
+
+    from src.snapshot import SalesSnapshot
+
+    parser = argparse.ArgumentParser(description='optimize prices for every product and write them to the db')
+    parser.add_argument('--by', nargs='+', default=['description'],
+                        help='columns defining a product, e.g. description cluster transaction_month')
+    parser.add_argument('--table', default='product_price_optimizer')
+    args = parser.parse_args()
+
+    print('syncing local snapshot...')
+    snapshot = SalesSnapshot()
+    snapshot.sync()
+    sold = snapshot.load(columns=list(set(args.by) | {'description', 'number_sold', 'dollars_sold'}))
+    sold['unit_price'] = np.round(sold.dollars_sold / sold.number_sold, 2)
+
+    print('optimizing...')
+    prices = optimize_prices(sold, args.by)
+
+    print('writing {} rows to db...'.format(prices.shape[0]))
+    push_table(prices, args.table, atomic=True)
+    print('complete.')
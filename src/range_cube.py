@@ -0,0 +1,217 @@
+import time
+import threading
+import numpy as np
+import pandas as pd
+import sys
+sys.path.append("..")
+from src.sales_cube import _index, _packed_keys, _PackedIndex
+
+STORE_COLS = ['cluster', 'property_code', 'category_name', 'description', 'transaction_month', 'number_sold']
+CLUSTER_COLS = ['cluster', 'category_name', 'description', 'transaction_month', 'number_sold']
+NATIONAL_COLS = ['category_name', 'description', 'transaction_month', 'number_sold']
+
+
+def month_range(month):
+    '''
+    (start, end) of a month argument: a single transaction_month or a (start, end) pair
+    '''
+    if isinstance(month, (tuple, list)):
+        return tuple(month)
+    return month, month
+
+def month_label(month):
+    start, end = month_range(month)
+    return start if start == end else '{} to {}'.format(start, end)
+
+
+class _PrefixSums(object):
+    '''
+    number_sold of every (keys, description) item summed over months 0..j, for every j.
+    Items are sorted by keys so each key is one contiguous block of rows
+    '''
+
+    def __init__(self, df, keys, months):
+        self.keys = keys
+        self.group = keys + ['description']
+        agg = df.groupby(self.group + ['transaction_month'], observed=True).number_sold.sum().reset_index()
+        items = agg.groupby(self.group, observed=True).ngroup().values
+        self.items = agg.groupby(self.group, observed=True).size().reset_index()[self.group]
+        self.idx = _index(self.items, keys)
+
+        # column 0 is the empty prefix, so a range is prefix[end] - prefix[start]
+        pos = np.searchsorted(months, agg.transaction_month.astype(str).values)
+        sold = np.zeros((self.items.shape[0], len(months) + 1), dtype=np.int64)
+        np.add.at(sold, (items, pos + 1), agg.number_sold.values)
+        # one contiguous array per month boundary, so they can be published as columns
+        prefix = np.asfortranarray(np.cumsum(sold, axis=1))
+        self.prefix = [prefix[:, j] for j in range(prefix.shape[1])]
+
+    def frames(self):
+        '''
+        the items with a prefix_<j> column per month boundary, and their key positions
+        (see SalesCube.frames)
+        '''
+        items = self.items.copy()
+        for j, sold in enumerate(self.prefix):
+            items['prefix_{}'.format(j)] = sold
+        idx = self.idx.frame if isinstance(self.idx, _PackedIndex) else _packed_keys(self.idx, self.keys)
+        return items, idx
+
+    @classmethod
+    def from_frames(cls, items, keys_frame, keys):
+        '''
+        prefix sums over frames from frames(), used as they are
+        '''
+        sums = cls.__new__(cls)
+        sums.keys = keys
+        sums.group = keys + ['description']
+        sums.items = items # the prefix columns are left in, selecting around them would copy
+        cols = sorted((c for c in items.columns if c.startswith('prefix_')), key=lambda c: int(c[len('prefix_'):]))
+        sums.prefix = [items[c].values for c in cols]
+        sums.idx = _PackedIndex(keys_frame, keys)
+        return sums
+
+    def ranked(self, key, start, end, num = None):
+        first, last = self.idx.get(key, (0, 0))
+        sold = self.prefix[end][first:last] - self.prefix[start][first:last]
+        keep = sold > 0
+        rows = self.items.iloc[first:last][self.group][keep].copy()
+        rows['number_sold'] = sold[keep]
+        # best sellers first, ties broken by description, same as SalesCube
+        order = np.lexsort((rows.description.astype(str).values, -rows.number_sold.values))
+        return rows.iloc[order[:num] if num is not None else order].reset_index(drop=True)
+
+
+class RangeCube(object):
+    '''
+    SalesCube for any range of months
+
+    Inputs:
+        df = DataFrame containing sales data for every month ranges may cover
+
+    Monthly number_sold of every store, cluster and national product is kept as a running
+    total over the months, so the sum over any (start_month, end_month) is the difference
+    of two columns. A range lookup costs the same as a single month one, however many
+    months it spans. Memory is one int64 per product per month at each level.
+
+    Every method takes month as a single transaction_month or a (start, end) pair, both
+    inclusive. The frames returned have the same columns as SalesCube's, with the range
+    label (see month_label) as transaction_month.
+
+    Methods:
+        sold_by_store(property_code, category, month)
+        top_sold_by_cluster(cluster, category, month, num)
+        top_sold_overall(category, month, num)
+        cluster_of(property_code)
+        describe(property_code)
+        frames() / from_frames(...) : as SalesCube's, e.g. to publish it to shared memory
+
+    Attributes:
+        months_ : the transaction_months covered
+    '''
+
+    def __init__(self, df):
+        df = df[df.number_sold > 0]
+        self.months_ = np.array(sorted(df.transaction_month.astype(str).unique()))
+        self._store = _PrefixSums(df, ['property_code', 'category_name'], self.months_)
+        self._cluster = _PrefixSums(df, ['cluster', 'category_name'], self.months_)
+        self._national = _PrefixSums(df, ['category_name'], self.months_)
+
+        self._clusters = df.groupby('property_code', observed=True).cluster.max().to_dict()
+        self._props = df[['property_code', 'flag_name', 'city', 'state']]. \
+            drop_duplicates('property_code').set_index('property_code')
+
+    def frames(self):
+        '''
+        the frames from_frames rebuilds the cube from: months, props, and the items and key
+        positions of every level (store, store_keys, ...)
+        '''
+        props = self._props.reset_index()
+        props['cluster'] = [self._clusters.get(p, np.nan) for p in props.property_code]
+        frames = {'months': pd.DataFrame({'transaction_month': self.months_}), 'props': props}
+        for level, sums in [('store', self._store), ('cluster', self._cluster), ('national', self._national)]:
+            frames[level], frames[level + '_keys'] = sums.frames()
+        return frames
+
+    @classmethod
+    def from_frames(cls, months, props, store, store_keys, cluster, cluster_keys, national, national_keys):
+        cube = cls.__new__(cls)
+        cube.months_ = np.asarray(months.transaction_month.astype(str).values)
+        cube._store = _PrefixSums.from_frames(store, store_keys, ['property_code', 'category_name'])
+        cube._cluster = _PrefixSums.from_frames(cluster, cluster_keys, ['cluster', 'category_name'])
+        cube._national = _PrefixSums.from_frames(national, national_keys, ['category_name'])
+        cube._clusters = dict(zip(props.property_code, props.cluster))
+        cube._props = props.set_index('property_code')[['flag_name', 'city', 'state']]
+        return cube
+
+    def _bounds(self, month):
+        start, end = month_range(month)
+        return np.searchsorted(self.months_, start, 'left'), np.searchsorted(self.months_, end, 'right')
+
+    def sold_by_store(self, property_code, category, month):
+        store = self._store.ranked((property_code, category), *self._bounds(month))
+        store['cluster'] = self.cluster_of(property_code)
+        store['transaction_month'] = month_label(month)
+        store = store[STORE_COLS].copy()
+        store['pct_of_sold'] = store.number_sold / store.number_sold.sum()
+        store['cum_pct'] = store.pct_of_sold.cumsum()
+        return store
+
+    def top_sold_by_cluster(self, cluster, category, month, num):
+        clust = self._cluster.ranked((cluster, category), *self._bounds(month), num)
+        clust['transaction_month'] = month_label(month)
+        return clust[CLUSTER_COLS]
+
+    def top_sold_overall(self, category, month, num):
+        natl = self._national.ranked((category,), *self._bounds(month), num)
+        natl['transaction_month'] = month_label(month)
+        return natl[NATIONAL_COLS]
+
+    def cluster_of(self, property_code):
+        return self._clusters.get(property_code, np.nan)
+
+    def describe(self, property_code):
+        return self._props.loc[property_code]
+
+
+class RangeCubeCache(object):
+    '''
+    One RangeCube over the whole history, shared by every request
+
+    Inputs:
+        loader = function() returning the sales DataFrame of every month
+        ttl = seconds before the cube is rebuilt
+
+    The cube is built on first use. After ttl, or invalidate(), the next get()
+    rebuilds it while other requests keep reading the old one.
+
+    Methods:
+        get() : the current RangeCube
+        invalidate() : rebuild on next use
+    '''
+
+    def __init__(self, loader, ttl = 3600):
+        self.loader = loader
+        self.ttl = ttl
+        self._cube = None
+        self._built_at = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        cube = self._cube
+        if cube is not None and time.time() - self._built_at < self.ttl:
+            return cube
+        if cube is not None and not self._lock.acquire(blocking=False):
+            return cube # someone else is rebuilding
+        if cube is None:
+            self._lock.acquire()
+        try:
+            if self._cube is cube:
+                self._cube = RangeCube(self.loader())
+                self._built_at = time.time()
+            return self._cube
+        finally:
+            self._lock.release()
+
+    def invalidate(self):
+        self._built_at = 0
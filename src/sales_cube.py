@@ -0,0 +1,202 @@
+import pandas as pd
+import numpy as np
+
+STORE_KEYS = ['property_code', 'category_name', 'transaction_month']
+CLUSTER_KEYS = ['cluster', 'category_name', 'transaction_month']
+NATIONAL_KEYS = ['category_name', 'transaction_month']
+
+
+def _text_order(col):
+    '''
+    sort key for a column: a categorical's codes follow its category list, which a shared
+    SalesDictionary appends to unsorted, so they are swapped for the rank of each
+    category's text. Other columns sort as they are
+    '''
+    if col.name != 'description' or not isinstance(col.dtype, pd.CategoricalDtype):
+        return col
+    cats = col.cat.categories
+    rank = np.empty(len(cats), dtype=np.int64)
+    rank[np.argsort(np.asarray(cats.astype(str)), kind='mergesort')] = np.arange(len(cats))
+    codes = col.cat.codes.values
+    return pd.Series(np.where(codes >= 0, rank[codes], -1), index=col.index)
+
+def _aggregate(df, group_cols, keys):
+    '''
+    sums number_sold over group_cols and sorts so that every key is one contiguous
+    block, best sellers first (ties broken by the description's text, as SqlSales'
+    ORDER BY description, however the column is encoded)
+    '''
+    agg = df[group_cols + ['number_sold']][df.number_sold > 0]. \
+        groupby(group_cols, as_index=False, observed=True).sum()
+    agg = agg.sort_values(by=keys + ['number_sold', 'description'],
+                          ascending=[True] * len(keys) + [False, True],
+                          kind='mergesort', key=_text_order).reset_index(drop=True)
+    return agg
+
+def _index(agg, keys):
+    '''
+    maps every key tuple to the (start, stop) row positions of its block in agg
+    '''
+    bounds = {}
+    for key, rows in agg.groupby(keys, sort=False, observed=True).indices.items():
+        if not isinstance(key, tuple):
+            key = (key,)
+        bounds[key] = (rows[0], rows[-1] + 1)
+    return bounds
+
+def _packed_keys(idx, keys):
+    '''
+    an _index dict as a frame: the key columns as categoricals, the (start, stop) rows of
+    every key, and the key's category codes packed into one int64 (mixed radix), sorted
+    '''
+    frame = pd.DataFrame([tuple(key) + tuple(rows) for key, rows in idx.items()],
+                         columns=keys + ['start', 'stop'])
+    packed = np.zeros(frame.shape[0], dtype=np.int64)
+    mult = 1
+    for col in reversed(keys):
+        cat = pd.Categorical(frame[col])
+        frame[col] = cat
+        packed += cat.codes.astype(np.int64) * mult
+        mult *= max(len(cat.categories), 1)
+    frame['packed'] = packed
+    return frame.sort_values('packed').reset_index(drop=True)
+
+
+class _PackedIndex(object):
+    '''
+    key tuple -> (start, stop) lookups on a frame from _packed_keys, by binary search of
+    the packed codes. Unlike an _index dict it holds no Python object per key, so over
+    memory-mapped frames the only per-process memory is the key columns' categories
+    '''
+
+    def __init__(self, frame, keys):
+        self.frame = frame
+        self.categories = [frame[col].cat.categories for col in keys]
+        self.mults = []
+        mult = 1
+        for cats in reversed(self.categories):
+            self.mults.insert(0, mult)
+            mult *= max(len(cats), 1)
+        self.packed = frame.packed.values
+        self.start = frame.start.values
+        self.stop = frame.stop.values
+
+    def get(self, key, default = None):
+        code = 0
+        for cats, mult, value in zip(self.categories, self.mults, key):
+            try:
+                code += cats.get_loc(value) * mult
+            except KeyError:
+                return default
+        pos = np.searchsorted(self.packed, code)
+        if pos < self.packed.shape[0] and self.packed[pos] == code:
+            return int(self.start[pos]), int(self.stop[pos])
+        return default
+
+
+class SalesCube(object):
+    '''
+    Pre-aggregated number_sold by (property, cluster, national) x category x month
+
+    Inputs:
+        df = DataFrame containing sales data (the product_category_recommender table,
+             or any month slice of it)
+
+    The groupbys behind sold_by_store, top_sold_by_cluster and top_sold_overall are
+    run once when the cube is built. Each lookup afterwards is a dictionary hit
+    followed by a positional slice of an already sorted frame.
+
+    Methods:
+        sold_by_store(property_code, category, month) : all products sold by the store,
+            with pct_of_sold and cum_pct
+        top_sold_by_cluster(cluster, category, month, num) : top num products in a cluster
+        top_sold_overall(category, month, num) : top num products nationally
+        cluster_of(property_code) : cluster the property belongs to
+        describe(property_code) : flag_name, city and state of the property
+
+    Attributes:
+        store_, cluster_, national_ : the sorted aggregate frames
+        nbytes_ : approximate memory held by the aggregates
+    '''
+
+    def __init__(self, df):
+        store = _aggregate(df, ['cluster', 'property_code', 'category_name', 'description', 'transaction_month'],
+                           STORE_KEYS)
+        total_sold = store.groupby(STORE_KEYS, sort=False, observed=True).number_sold.transform('sum')
+        store['pct_of_sold'] = store.number_sold / total_sold
+        store['cum_pct'] = store.groupby(STORE_KEYS, sort=False, observed=True).pct_of_sold.cumsum()
+        cluster = _aggregate(df, ['cluster', 'category_name', 'description', 'transaction_month'],
+                             CLUSTER_KEYS)
+        national = _aggregate(df, ['category_name', 'description', 'transaction_month'],
+                              NATIONAL_KEYS)
+        props = df.groupby('property_code', observed=True). \
+            agg({'flag_name': 'first', 'city': 'first', 'state': 'first', 'cluster': 'max'}).reset_index()
+        self._set_frames(store, cluster, national, props)
+
+    def _set_frames(self, store, cluster, national, props, keys = None):
+        self.store_ = store
+        self.cluster_ = cluster
+        self.national_ = national
+        if keys is None:
+            self._store_idx = _index(self.store_, STORE_KEYS)
+            self._cluster_idx = _index(self.cluster_, CLUSTER_KEYS)
+            self._national_idx = _index(self.national_, NATIONAL_KEYS)
+        else:
+            self._store_idx = _PackedIndex(keys['store'], STORE_KEYS)
+            self._cluster_idx = _PackedIndex(keys['cluster'], CLUSTER_KEYS)
+            self._national_idx = _PackedIndex(keys['national'], NATIONAL_KEYS)
+
+        self._clusters = dict(zip(props.property_code, props.cluster))
+        self._props = props.set_index('property_code')[['flag_name', 'city', 'state']]
+        self.nbytes_ = int(sum(frame.memory_usage(deep=True).sum()
+                               for frame in (self.store_, self.cluster_, self.national_)))
+
+    def frames(self):
+        '''
+        the frames from_frames rebuilds the cube from, e.g. to publish them to shared memory,
+        including the key positions of every aggregate (store_keys, ...) as plain columns
+        '''
+        props = self._props.reset_index()
+        props['cluster'] = [self._clusters[p] for p in props.property_code]
+        frames = {'store': self.store_, 'cluster': self.cluster_, 'national': self.national_, 'props': props}
+        for level, idx, keys in [('store', self._store_idx, STORE_KEYS),
+                                 ('cluster', self._cluster_idx, CLUSTER_KEYS),
+                                 ('national', self._national_idx, NATIONAL_KEYS)]:
+            frames[level + '_keys'] = idx.frame if isinstance(idx, _PackedIndex) else _packed_keys(idx, keys)
+        return frames
+
+    @classmethod
+    def from_frames(cls, store, cluster, national, props, store_keys = None, cluster_keys = None,
+                    national_keys = None):
+        '''
+        a cube over already aggregated frames (as returned by frames()), used as they are.
+        With the *_keys frames lookups binary search them; without, the key indexes are
+        rebuilt as dicts
+        '''
+        cube = cls.__new__(cls)
+        keys = None
+        if store_keys is not None:
+            keys = {'store': store_keys, 'cluster': cluster_keys, 'national': national_keys}
+        cube._set_frames(store, cluster, national, props, keys)
+        return cube
+
+    def _slice(self, frame, idx, key, num=None):
+        start, stop = idx.get(key, (0, 0))
+        if num is not None:
+            stop = min(stop, start + num)
+        return frame.iloc[start:stop]
+
+    def sold_by_store(self, property_code, category, month):
+        return self._slice(self.store_, self._store_idx, (property_code, category, month))
+
+    def top_sold_by_cluster(self, cluster, category, month, num):
+        return self._slice(self.cluster_, self._cluster_idx, (cluster, category, month), num)
+
+    def top_sold_overall(self, category, month, num):
+        return self._slice(self.national_, self._national_idx, (category, month), num)
+
+    def cluster_of(self, property_code):
+        return self._clusters.get(property_code, np.nan)
+
+    def describe(self, property_code):
+        return self._props.loc[property_code]
@@ -0,0 +1,288 @@
+import os
+import numpy as np
+import sys
+sys.path.append("..")
+from src.get_clusters import get_table
+from src.category_recommender import compare_products, recommend, recommend_many, known_property, \
+    add_peer_lines
+from src.month_cache import MonthCache
+from src.sql_recommender import SqlSales
+from src.incremental import AggregateSales
+from src.snapshot import SalesSnapshot
+from src.encoding import SalesDictionary, encode_sales
+from src.price_optimizer import prod_subset
+from src.chart_service import ChartRenderer
+from src.elasticity import ElasticityTable, parse_price
+from src.dimensions import Dimensions
+from src.range_cube import RangeCubeCache
+from src.category_recommender_class import get_recommender
+from src.shared_dataset import SharedSalesCube
+from src.peer_index import similar_properties
+from src import metrics
+from src.metrics import timed
+
+# app.config defaults of both app/app.py (Flask) and app/async_app.py (Quart)
+CONFIG = {
+    'BASIC_AUTH_USERNAME': 'impulsify',
+    'BASIC_AUTH_PASSWORD': 'superhighsecurity',
+    'BASIC_AUTH_FORCE': True, # every page asks for the login
+    'USE_PRECOMPUTED_RECOMMENDATIONS': True, # read results of src/batch_recommender.py when available
+    'DB_POOL_SIZE': 10, # max open connections; requests past this wait for one
+    'EXECUTOR_THREADS': 8, # async app only: threads running pandas / matplotlib work
+    'MONTH_CACHE_BYTES': 2 * 1024**3, # memory allowed for cached month slices
+    'MONTH_CACHE_TTL': 3600, # seconds before a cached month is re-read
+    'SNAPSHOT_DIR': None, # directory synced by src/snapshot.py; month slices are read from it when set
+    'CHART_PROCESSES': 2, # worker processes drawing price optimizer charts
+    'RECOMMENDER_MODE': 'pandas', # 'pandas' ranks cached month slices in process, 'sql' ranks in Postgres,
+                                  # 'aggregates' reads the tables kept by src/incremental.py,
+                                  # 'engine' serves every month from the process-wide CategoryRecommender,
+                                  # 'shared' attaches to the cubes (month and range) published by src/shared_dataset.py
+    'ELASTICITY_TTL': 3600, # seconds before the demand curves are re-read
+    'DIMENSION_TTL': 600, # seconds before the dropdown lists are refreshed in the background
+    'API_BATCH_LIMIT': 5000, # most (property, category) items one batch API request may ask for
+    'SLOW_REQUEST_SECONDS': 2.0, # requests slower than this are logged with a per stage breakdown, None disables
+    'PEER_COUNT': 10, # similar hotels (src/peer_index.py) listed next to the cluster; None disables
+    }
+
+HISTORY_COLS = ['property_code', 'cluster', 'flag_name', 'city', 'state', 'category_name',
+              'description', 'transaction_month', 'number_sold']
+MONTH_SQL = """SELECT *
+            FROM product_category_recommender
+            WHERE transaction_month = %(month)s
+            """
+PRODUCT_SQL = "SELECT * FROM product_category_recommender WHERE description = %(description)s"
+
+
+def api_month(value):
+    '''
+    month of a batch API body: a transaction_month, or a [start, end] pair as a (start, end)
+    range. None if it is neither
+    '''
+    if isinstance(value, str) and value:
+        return value
+    if isinstance(value, list) and len(value) == 2 and all(isinstance(m, str) and m for m in value):
+        return (min(value), max(value))
+    return None
+
+def request_month(values):
+    '''
+    month, or the (start, end) range when an end_month other than month is given
+    '''
+    month = values['month']
+    end_month = values.get('end_month')
+    if end_month and end_month != month:
+        return (min(month, end_month), max(month, end_month))
+    return month
+
+def lookup_args(values, filter_cols):
+    '''
+    filters, sort and page of a lookup request, from the query string or a posted form
+    '''
+    filters = {col: values.get(col) or None for col in filter_cols}
+    sort = values.get('sort') or None
+    descending = values.get('desc') == '1'
+    page = values.get('page', 1, type=int)
+    return filters, sort, descending, page
+
+def recommendation_args(args):
+    '''
+    property, category, month, num and number of peers of an /api/recommendations query.
+    KeyError names a missing parameter
+    '''
+    return (args['property'], args['category'], request_month(args), args.get('num', 5, type=int),
+            args.get('peers', 0, type=int)) # ask for k similar hotels' top products too
+
+def batch_args(body, limit):
+    '''
+    inputs: body = {"month": "2019-09", "num": 5, "items": [{"property": ..., "category": ...}, ...]}
+            limit = most items allowed
+    outputs: month, num and the (property, category) pairs. ValueError with the message
+            for the client if the body isn't valid
+    '''
+    items = body.get('items')
+    month = api_month(body.get('month'))
+    if month is None or not isinstance(items, list):
+        raise ValueError('month (a month or a [start, end] pair) and a list of items are required')
+    if len(items) > limit:
+        raise ValueError('at most {} items per request'.format(limit))
+    try:
+        pairs = [(item['property'], item['category']) for item in items]
+        num = int(body.get('num', 5))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('every item needs a property and a category')
+    if not all(isinstance(p, str) and isinstance(c, str) for p, c in pairs):
+        raise ValueError('property and category must be strings')
+    return month, num, pairs
+
+def end_request(logger, path, slow):
+    '''
+    closes the request's timings, logging them per stage when it took longer than slow seconds
+    '''
+    seconds, stages = metrics.end_request()
+    if slow is not None and seconds > slow:
+        logger.warning('slow request %s %.3fs: %s', path, seconds,
+                       ', '.join('{} {:.3f}s'.format(stage, s) for stage, s in stages))
+
+
+class Serving(object):
+    '''
+    The caches and lookups behind both apps' pages and API. Every method blocks, so the
+    async app only calls them inside run_sync
+
+    Inputs:
+        config = app.config, with the keys of CONFIG
+        root_path = app.root_path; charts are drawn into its static/charts
+        read = function(sql, params) returning a DataFrame, defaults to get_table (the
+               psycopg2 pool). The async app passes its AsyncDatabase.blocking
+
+    Methods:
+        recommendation_source(month) : what recommend reads month from, per RECOMMENDER_MODE
+        similar_hotels(property_code, k) : the property's peers, None if there are none
+        compare(property_code, category, month, num, peers) : compare_products lines
+        with_peers(lines, peers, category, month, num) : precomputed lines with the peers added
+        api_recommendation(property_code, category, month, num, k) : recommend, None if unknown
+        recommend_many(pairs, month, num)
+        price_optimizer_page(product_description, raw, what_if_price) : template values
+
+    Attributes:
+        dimensions, month_cache, range_cubes, shared_cube, elasticities, chart_renderer
+    '''
+
+    def __init__(self, config, root_path, read = None):
+        self.config = config
+        self.read = read or (lambda sql, params = None: get_table(sql, params=params))
+
+        # dropdown lists are read from the dimension tables on first use and refreshed in the background
+        self.dimensions = Dimensions(ttl=config['DIMENSION_TTL'], read=self.read)
+        self.snapshot = SalesSnapshot(config['SNAPSHOT_DIR']) if config['SNAPSHOT_DIR'] else None
+        self.sales_dictionary = SalesDictionary() # shared by every frame this process loads
+
+        self.month_cache = MonthCache(self.load_month, max_bytes=config['MONTH_CACHE_BYTES'],
+                                      ttl=config['MONTH_CACHE_TTL'], latest_loader=self.latest_month)
+        # a new month showing up drops the cached copy of the previous newest month right away
+        self.dimensions.on_change('months', lambda months: self.month_cache.sync_latest(months[0] if months else None))
+
+        # month range recommendations, built on the first range request
+        self.range_cubes = RangeCubeCache(self.load_history, ttl=config['MONTH_CACHE_TTL'])
+        self.dimensions.on_change('months', lambda months: self.range_cubes.invalidate())
+        # every worker maps the same published files instead of holding its own copy
+        self.shared_cube = SharedSalesCube()
+        if config['RECOMMENDER_MODE'] == 'engine':
+            self.dimensions.on_change('months', lambda months: self.engine().refresh())
+
+        # fitted by src/elasticity.py, read on first what-if query
+        self.elasticities = ElasticityTable(read=self.read, ttl=config['ELASTICITY_TTL'])
+        self.chart_renderer = ChartRenderer(os.path.join(root_path, 'static', 'charts'),
+                                            processes=config['CHART_PROCESSES'])
+
+    def load_month(self, month):
+        if self.snapshot is not None and month in self.snapshot.months():
+            return self.snapshot.load([month], dictionary=self.sales_dictionary)
+        return encode_sales(self.read(MONTH_SQL, {'month': month}), self.sales_dictionary)
+
+    def latest_month(self):
+        months = self.dimensions.get('months')
+        return months[0] if months else None
+
+    def load_history(self):
+        if self.snapshot is not None:
+            return self.snapshot.load(columns=HISTORY_COLS, dictionary=self.sales_dictionary)
+        sql = 'SELECT {} FROM product_category_recommender'.format(', '.join(HISTORY_COLS))
+        return encode_sales(self.read(sql, None), self.sales_dictionary)
+
+    def engine(self):
+        return get_recommender(self.load_history, self.config['MONTH_CACHE_TTL'])
+
+    def recommendation_source(self, month):
+        '''
+        what compare_products / recommend read the month from, per RECOMMENDER_MODE.
+        A (start, end) range is answered from a range cube: the published one in 'shared'
+        mode, else the one this process builds over the whole history
+        '''
+        mode = self.config['RECOMMENDER_MODE']
+        if isinstance(month, tuple):
+            with timed('range_cube'):
+                if mode == 'shared':
+                    cube = self.shared_cube.range_cube()
+                    if cube is not None:
+                        return cube # otherwise this worker builds its own, as in the other modes
+                return self.range_cubes.get()
+        if mode == 'sql':
+            return SqlSales(read=self.read)
+        if mode == 'shared':
+            cube = self.shared_cube.get()
+            if cube is not None:
+                return cube # until something is published, the month cache answers
+        if mode == 'engine':
+            return self.engine().snapshot().cube
+        if mode == 'aggregates':
+            return AggregateSales(read=self.read)
+        with timed('month_cache'):
+            return self.month_cache.get(month)
+
+    def similar_hotels(self, property_code, k = None):
+        '''
+        the property's k (PEER_COUNT by default) nearest peers from the saved PeerIndex, or
+        None when peers are disabled, no index has been built or the property is unknown
+        '''
+        k = k or self.config['PEER_COUNT']
+        if not k:
+            return None
+        try:
+            with timed('peers'):
+                return similar_properties(property_code, k, read=self.read)
+        except (FileNotFoundError, KeyError):
+            return None
+
+    def compare(self, property_code, category, month, num, peers = None):
+        return compare_products(property_code, category, month, num, self.recommendation_source(month), peers)
+
+    def with_peers(self, lines, peers, category, month, num):
+        if peers is None:
+            return lines
+        # the batch job doesn't know the peers, only their top products are computed live
+        return add_peer_lines(lines, peers, category, month, num, self.recommendation_source(month))
+
+    def api_recommendation(self, property_code, category, month, num, k = 0):
+        source = self.recommendation_source(month)
+        if not known_property(property_code, source):
+            return None
+        peers = self.similar_hotels(property_code, k) if k > 0 else None
+        return recommend(property_code, category, month, num, source, peers)
+
+    def recommend_many(self, pairs, month, num):
+        return recommend_many(pairs, month, num, self.recommendation_source(month))
+
+    def price_optimizer_page(self, product_description = None, raw = None, what_if_price = None):
+        '''
+        inputs: product_description = product posted to the price optimizer, None for the empty page
+                raw = the product's rows of product_category_recommender (PRODUCT_SQL)
+                what_if_price = (optional) price typed into the what-if box
+
+        outputs: keyword arguments of price_optimizer.html. The charts are drawn in the
+                background and the page polls for the images until they exist
+        '''
+        page = {'descriptions': [], 'product_description': product_description, 'sold': None,
+                'best_price': None, 'best_sales': None, 'best_rev': None, 'chart1': None, 'chart2': None,
+                'charts_failed': None, 'charts_failed_url': None, 'what_if': None, 'what_if_error': None}
+        if product_description is None:
+            return page
+        if what_if_price:
+            price = parse_price(what_if_price)
+            if price is None:
+                page['what_if_error'] = 'Enter the what-if price as a positive number, e.g. 2.49'
+            else:
+                # evaluates the stored demand curve, no refit
+                page['what_if'] = self.elasticities.what_if(product_description, price)
+                if page['what_if'] is None:
+                    page['what_if_error'] = 'No demand curve could be fit for this product (it has sold at too few prices)'
+
+        sold = encode_sales(raw, self.sales_dictionary)
+        sold['unit_price'] = np.round(sold.dollars_sold / sold.number_sold, 2)
+        prod = prod_subset(sold, product_description)
+        charts = self.chart_renderer.request(sold, product_description)
+        page.update(sold=sold, best_price='{0:.2f}'.format(prod.best_price_),
+                    best_sales='{0:.0f}'.format(prod.best_sales_), best_rev='{0:.0f}'.format(prod.best_rev_),
+                    chart1=charts['boxplot'], chart2=charts['distributions'],
+                    charts_failed=charts['failed'], charts_failed_url=charts['failed_url'])
+        return page
@@ -0,0 +1,177 @@
+import os
+import time
+import shutil
+import threading
+import argparse
+import pyarrow as pa
+import sys
+sys.path.append("..")
+from src.sales_cube import SalesCube
+from src.range_cube import RangeCube
+
+SHARED_DIR = '/dev/shm/store_recommender' # tmpfs, so the files are the shared memory
+CURRENT = 'CURRENT'
+RANGE_PREFIX = 'range_' # frames of the RangeCube published next to the SalesCube
+
+
+def _dataset_dir(name, root):
+    return os.path.join(root, name)
+
+def publish(frames, name = 'sales', root = SHARED_DIR):
+    '''
+    inputs:
+        frames = dict of frame name -> DataFrame
+        name = dataset name, workers attach by it
+        root = directory on a tmpfs (/dev/shm) the files are written to
+
+    outputs:
+        the generation id written
+
+    Each frame is written as an uncompressed Arrow IPC file in a new generation
+    directory, then CURRENT is switched to it with a rename, so workers only ever see
+    complete generations. The previous generation is kept, so a worker that read
+    CURRENT just before the switch can still open its files; older ones are deleted.
+    Workers that still have them mapped keep reading them until they re-attach, since
+    unlinking a file doesn't unmap it.
+    '''
+    base = _dataset_dir(name, root)
+    generation = '{}-{}'.format(int(time.time() * 1000), os.getpid())
+    path = os.path.join(base, generation)
+    os.makedirs(path)
+    for key, frame in frames.items():
+        table = pa.Table.from_pandas(frame, preserve_index=False)
+        with pa.OSFile(os.path.join(path, key + '.arrow'), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+
+    tmp = os.path.join(base, CURRENT + '.tmp')
+    with open(tmp, 'w') as f:
+        f.write(generation)
+    os.replace(tmp, os.path.join(base, CURRENT))
+
+    # generation names start with the publish time, so they sort oldest first
+    generations = sorted((g for g in os.listdir(base) if os.path.isdir(os.path.join(base, g))),
+                         key=lambda g: int(g.split('-')[0]))
+    for old in generations[:-2]:
+        shutil.rmtree(os.path.join(base, old), ignore_errors=True)
+    return generation
+
+def current_generation(name = 'sales', root = SHARED_DIR):
+    try:
+        with open(os.path.join(_dataset_dir(name, root), CURRENT)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
+
+def _attach_generation(path):
+    frames = {}
+    for file in os.listdir(path):
+        table = pa.ipc.open_file(pa.memory_map(os.path.join(path, file), 'r')).read_all()
+        # split_blocks keeps each column its own (zero-copy) block instead of consolidating
+        frames[file[:-len('.arrow')]] = table.to_pandas(split_blocks=True, self_destruct=False)
+    return frames
+
+def attach(name = 'sales', root = SHARED_DIR, retries = 1):
+    '''
+    outputs:
+        (generation, dict of frame name -> DataFrame) of the current generation
+
+    The files are memory-mapped, so every worker reads the same physical pages.
+    Numeric columns and categorical codes are views on those pages, and the cube's key
+    positions are published as columns too (see SalesCube.frames), so only the category
+    dictionaries and pandas' bookkeeping are allocated per worker.
+
+    If a generation disappears while it is being opened (two publishes in quick
+    succession), the new CURRENT is read and attached instead, up to retries times.
+    FileNotFoundError if nothing has been published.
+    '''
+    while True:
+        generation = current_generation(name, root)
+        if generation is None:
+            raise FileNotFoundError('nothing published as {} in {}'.format(name, root))
+        try:
+            return generation, _attach_generation(os.path.join(_dataset_dir(name, root), generation))
+        except FileNotFoundError:
+            if retries <= 0:
+                raise
+            retries -= 1
+
+def publish_cube(cube, name = 'sales', root = SHARED_DIR, range_cube = None):
+    '''
+    publishes a SalesCube's aggregates, and optionally a RangeCube's prefix sums next to
+    them, so month range requests don't need a per worker copy of the history either
+    '''
+    frames = cube.frames()
+    if range_cube is not None:
+        frames.update((RANGE_PREFIX + key, frame) for key, frame in range_cube.frames().items())
+    return publish(frames, name, root)
+
+
+class SharedSalesCube(object):
+    '''
+    A worker's view of the SalesCube published by publish_cube
+
+    Inputs:
+        name, root = where the cube was published
+        check_interval = seconds between checks for a newer generation
+
+    Methods:
+        get() : the SalesCube of the newest generation, re-attaching when it changes.
+            None if nothing has been published yet
+        range_cube() : the RangeCube of the same generation, None if it was published
+            without one
+    '''
+
+    def __init__(self, name = 'sales', root = SHARED_DIR, check_interval = 30):
+        self.name = name
+        self.root = root
+        self.check_interval = check_interval
+        self._generation = None
+        self._cube = None
+        self._range_cube = None
+        self._last_check = 0
+        self._lock = threading.Lock()
+
+    def get(self):
+        if self._cube is not None and time.time() - self._last_check < self.check_interval:
+            return self._cube
+        with self._lock:
+            self._last_check = time.time()
+            generation = current_generation(self.name, self.root)
+            if generation is None:
+                return self._cube
+            if generation != self._generation:
+                generation, frames = attach(self.name, self.root)
+                ranges = {key[len(RANGE_PREFIX):]: frames.pop(key) for key in list(frames)
+                          if key.startswith(RANGE_PREFIX)}
+                self._range_cube = RangeCube.from_frames(**ranges) if ranges else None
+                self._cube = SalesCube.from_frames(**frames)
+                self._generation = generation
+            return self._cube
+
+    def range_cube(self):
+        self.get()
+        return self._range_cube
+
+if __name__ == "__main__":
+
+    from src.snapshot import SalesSnapshot
+
+    parser = argparse.ArgumentParser(description='publish the sales aggregates to shared memory for the app workers')
+    parser.add_argument('--name', default='sales')
+    parser.add_argument('--root', default=SHARED_DIR)
+    parser.add_argument('--without-ranges', action='store_true',
+                        help="don't publish the month range cube; each worker then builds its own on the first range request")
+    args = parser.parse_args()
+
+    print('syncing local snapshot...')
+    snapshot = SalesSnapshot()
+    snapshot.sync()
+    sold = snapshot.load()
+
+    print('aggregating...')
+    cube = SalesCube(sold)
+    range_cube = None if args.without_ranges else RangeCube(sold)
+
+    generation = publish_cube(cube, args.name, args.root, range_cube)
+    print('published generation {} to {}'.format(generation, os.path.join(args.root, args.name)))
@@ -0,0 +1,131 @@
+import os
+import json
+import pyarrow as pa
+import pyarrow.feather as feather
+import sys
+sys.path.append("..")
+from src.get_clusters import get_table
+from src.encoding import CATEGORICAL_COLS, encode_sales
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'snapshot')
+MANIFEST = 'manifest.json'
+
+
+class SalesSnapshot(object):
+    '''
+    Local copy of product_category_recommender, one Arrow IPC file per transaction_month
+
+    Inputs:
+        path = directory holding the month files and manifest.json
+        table = database table to mirror
+
+    Each month is fingerprinted by (row count, sum of number_sold, sum of dollars_sold,
+    sum of a hash of every row), so edits that keep the totals, like a property moving
+    cluster or a renamed description, still change it. sync() only downloads months
+    whose fingerprint changed since the last sync, and
+    load() memory-maps the files so reading them doesn't go through a database cursor.
+
+    Methods:
+        sync() : fetches new / changed months, deletes months no longer in the table
+        load(months, columns, dictionary) : compact encoded DataFrame of the requested
+            months (all by default)
+        months() : transaction_months available locally
+    '''
+
+    def __init__(self, path = SNAPSHOT_DIR, table = 'product_category_recommender'):
+        self.path = path
+        self.table = table
+
+    def _file(self, month):
+        return os.path.join(self.path, '{}.arrow'.format(month))
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.path, MANIFEST)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_manifest(self, manifest):
+        tmp = os.path.join(self.path, MANIFEST + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, os.path.join(self.path, MANIFEST))
+
+    def fingerprints(self):
+        # the row hashes are summed rather than concatenated, so no sort is needed
+        sql = '''SELECT transaction_month
+                    , COUNT(*) AS n_rows
+                    , COALESCE(SUM(number_sold), 0) AS number_sold
+                    , COALESCE(SUM(dollars_sold), 0) AS dollars_sold
+                    , SUM(hashtext(t::text)::bigint) AS row_hash
+                FROM {} t
+                GROUP BY transaction_month'''.format(self.table)
+        prints = get_table(sql)
+        return {str(row.transaction_month): [int(row.n_rows), float(row.number_sold), float(row.dollars_sold),
+                                             str(row.row_hash)]
+                for row in prints.itertuples()}
+
+    def sync(self):
+        '''
+        outputs:
+            (months fetched, months removed)
+        '''
+        os.makedirs(self.path, exist_ok=True)
+        manifest = self._read_manifest()
+        remote = self.fingerprints()
+
+        fetched = []
+        for month in sorted(remote):
+            if manifest.get(month) == remote[month] and os.path.exists(self._file(month)):
+                continue
+            sold = get_table('SELECT * FROM {} WHERE transaction_month = %(month)s'.format(self.table),
+                             params={'month': month})
+            tmp = self._file(month) + '.tmp'
+            feather.write_feather(sold, tmp, compression='uncompressed') # uncompressed so it can be memory-mapped
+            os.replace(tmp, self._file(month))
+            manifest[month] = remote[month]
+            self._write_manifest(manifest) # after every month, so an interrupted sync resumes where it stopped
+            fetched.append(month)
+
+        removed = sorted(set(manifest) - set(remote))
+        for month in removed:
+            del manifest[month]
+            self._write_manifest(manifest)
+            os.remove(self._file(month))
+
+        return fetched, removed
+
+    def months(self):
+        return sorted(self._read_manifest())
+
+    def load_arrow(self, months = None, columns = None):
+        if months is None:
+            months = self.months()
+        tables = []
+        for month in months:
+            with pa.memory_map(self._file(month)) as source:
+                tables.append(pa.ipc.open_file(source).read_all())
+        if not tables: # nothing synced yet
+            return pa.table({col: pa.array([], pa.string()) for col in columns or []})
+        table = pa.concat_tables(tables)
+        if columns is not None:
+            table = table.select(columns)
+        return table
+
+    def load(self, months = None, columns = None, dictionary = None):
+        table = self.load_arrow(months, columns)
+        # dictionary-encode the string columns in arrow so pandas gets categoricals
+        # directly instead of one python string per row
+        for i, name in enumerate(table.column_names):
+            if name in CATEGORICAL_COLS and not pa.types.is_dictionary(table.schema.field(i).type):
+                table = table.set_column(i, name, table.column(i).dictionary_encode())
+        return encode_sales(table.to_pandas(), dictionary)
+
+if __name__ == "__main__":
+
+    snapshot = SalesSnapshot()
+    print('syncing {} to {}...'.format(snapshot.table, os.path.abspath(snapshot.path)))
+    fetched, removed = snapshot.sync()
+    print('fetched: {}'.format(', '.join(fetched) or 'none'))
+    print('removed: {}'.format(', '.join(removed) or 'none'))
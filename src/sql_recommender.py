@@ -0,0 +1,185 @@
+import pandas as pd
+import sys
+sys.path.append("..")
+from src.get_clusters import get_table
+
+STORE_COLS = ['cluster', 'property_code', 'category_name', 'description', 'transaction_month']
+CLUSTER_COLS = ['cluster', 'category_name', 'description', 'transaction_month']
+NATIONAL_COLS = ['category_name', 'description', 'transaction_month']
+
+
+def _param(name, paramstyle):
+    if paramstyle == 'named': # sqlite3
+        return ':' + name
+    return '%(' + name + ')s' # psycopg2
+
+def _in(col, name, values, paramstyle, params):
+    '''
+    condition that col is one of values, adding the bind parameters to params. sqlite3
+    has no arrays, so the named style binds one parameter per value
+    '''
+    if paramstyle == 'named':
+        names = ['{}{}'.format(name, i) for i in range(len(values))]
+        params.update(zip(names, values))
+        return '{} IN ({})'.format(col, ', '.join(_param(n, paramstyle) for n in names))
+    params[name] = list(values)
+    return '{} = ANY({})'.format(col, _param(name, paramstyle))
+
+def ranked_sql(group_cols, keys, filters, num = None, with_pct = False,
+               table = 'product_category_recommender', paramstyle = 'pyformat', where = ()):
+    '''
+    inputs:
+        group_cols = columns to sum number_sold over
+        keys = columns that define one ranking (PARTITION BY)
+        filters = columns to filter on; each becomes a bind parameter of the same name
+        num = (optional) keep only the top num rows of each partition
+        with_pct = also return pct_of_sold and cum_pct within each partition
+        paramstyle = 'pyformat' for psycopg2, 'named' for sqlite3
+        where = (optional) further conditions, e.g. from _in
+
+    outputs:
+        SQL returning group_cols, number_sold (and pct columns) ordered best seller first
+        within each partition, ties broken by description, same as SalesCube. number_sold
+        is cast back to an integer, since Postgres sums a BIGINT column as NUMERIC
+    '''
+    cols = ', '.join(group_cols)
+    partition = ', '.join(keys)
+    order = 'number_sold DESC, description'
+    where = ' AND '.join(['number_sold > 0'] + ['{} = {}'.format(c, _param(c, paramstyle)) for c in filters] +
+                         list(where))
+
+    pct = ''
+    cum_pct = ''
+    if with_pct:
+        pct = ''',
+                CAST(number_sold AS DOUBLE PRECISION) / SUM(number_sold) OVER (PARTITION BY {}) AS pct_of_sold'''.format(partition)
+        cum_pct = ''',
+            SUM(pct_of_sold) OVER (PARTITION BY {} ORDER BY sales_rank
+                                   ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW) AS cum_pct'''.format(partition)
+    top = ''
+    if num is not None:
+        top = 'WHERE sales_rank <= {}'.format(_param('num', paramstyle))
+
+    return '''
+        SELECT {cols}, number_sold{pct_cols}{cum_pct}
+        FROM (
+            SELECT {cols}, number_sold,
+                ROW_NUMBER() OVER (PARTITION BY {partition} ORDER BY {order}) AS sales_rank{pct}
+            FROM (
+                SELECT {cols}, CAST(SUM(number_sold) AS BIGINT) AS number_sold
+                FROM {table}
+                WHERE {where}
+                GROUP BY {cols}
+            ) agg
+        ) ranked
+        {top}
+        ORDER BY {partition}, sales_rank
+        '''.format(cols=cols, pct_cols=', pct_of_sold' if with_pct else '', cum_pct=cum_pct,
+                   partition=partition, order=order, pct=pct, table=table, where=where, top=top)
+
+
+class SqlSales(object):
+    '''
+    Answers the same lookups as SalesCube, but ranks in the database so only the
+    rows compare_products shows come back over the wire
+
+    Inputs:
+        read = function(sql, params) returning a DataFrame, defaults to get_table
+        table = sales table to query
+        paramstyle = 'pyformat' for psycopg2, 'named' for sqlite3
+
+    Methods:
+        sold_by_store(property_code, category, month)
+        top_sold_by_cluster(cluster, category, month, num)
+        top_sold_overall(category, month, num)
+        top_sold_by_properties(property_codes, category, month, num)
+        sold_by_stores(property_codes, categories, month)
+        cluster_of(property_code)
+        describe(property_code)
+    '''
+
+    def __init__(self, read = None, table = 'product_category_recommender', paramstyle = 'pyformat'):
+        self.read = read or (lambda sql, params: get_table(sql, params=params))
+        self.table = table
+        self.paramstyle = paramstyle
+
+    def _sql(self, group_cols, keys, filters, num = None, with_pct = False, where = ()):
+        return ranked_sql(group_cols, keys, filters, num, with_pct, self.table, self.paramstyle, where)
+
+    def sold_by_store(self, property_code, category, month):
+        sql = self._sql(STORE_COLS, ['property_code', 'category_name', 'transaction_month'],
+                        ['property_code', 'category_name', 'transaction_month'], with_pct=True)
+        return self.read(sql, {'property_code': property_code, 'category_name': category,
+                               'transaction_month': month})
+
+    def top_sold_by_cluster(self, cluster, category, month, num):
+        sql = self._sql(CLUSTER_COLS, ['cluster', 'category_name', 'transaction_month'],
+                        ['cluster', 'category_name', 'transaction_month'], num)
+        return self.read(sql, {'cluster': cluster, 'category_name': category,
+                               'transaction_month': month, 'num': num})
+
+    def top_sold_overall(self, category, month, num):
+        sql = self._sql(NATIONAL_COLS, ['category_name', 'transaction_month'],
+                        ['category_name', 'transaction_month'], num)
+        return self.read(sql, {'category_name': category, 'transaction_month': month, 'num': num})
+
+    def top_sold_by_properties(self, property_codes, category, month, num):
+        '''
+        top num products summed over several properties (e.g. a property's peers), in one query
+        '''
+        params = {'category_name': category, 'transaction_month': month, 'num': num}
+        in_codes = _in('property_code', 'property_codes', property_codes, self.paramstyle, params)
+        sql = '''SELECT description, CAST(SUM(number_sold) AS BIGINT) AS number_sold
+                    FROM {table}
+                    WHERE number_sold > 0 AND {in_codes}
+                        AND category_name = {category} AND transaction_month = {month}
+                    GROUP BY description
+                    ORDER BY number_sold DESC, description
+                    LIMIT {num}'''.format(table=self.table, in_codes=in_codes,
+                                          category=_param('category_name', self.paramstyle),
+                                          month=_param('transaction_month', self.paramstyle),
+                                          num=_param('num', self.paramstyle))
+        return self.read(sql, params)
+
+    def _properties_sql(self, in_codes):
+        return '''SELECT property_code, MAX(cluster) AS cluster, MAX(flag_name) AS flag_name,
+                        MAX(city) AS city, MAX(state) AS state
+                    FROM {} WHERE {} GROUP BY property_code'''.format(self.table, in_codes)
+
+    def sold_by_stores(self, property_codes, categories, month):
+        '''
+        store slices of several properties in several categories, with each property's
+        cluster, flag_name, city and state, in one query (e.g. for recommend_many)
+
+        outputs:
+            one row per property and product sold, ranked as sold_by_store, and a single
+            row with a null description for a property that sold nothing in categories.
+            Properties without any sales are left out
+        '''
+        params = {'transaction_month': month}
+        in_codes = _in('property_code', 'property_codes', property_codes, self.paramstyle, params)
+        in_categories = _in('category_name', 'categories', categories, self.paramstyle, params)
+        slices = self._sql(STORE_COLS, ['property_code', 'category_name', 'transaction_month'],
+                           ['transaction_month'], with_pct=True, where=[in_codes, in_categories])
+        sql = '''SELECT props.property_code, props.cluster, props.flag_name, props.city, props.state,
+                        slices.category_name, slices.description, slices.number_sold,
+                        slices.pct_of_sold, slices.cum_pct
+                    FROM ({props}) props
+                    LEFT JOIN ({slices}) slices ON slices.property_code = props.property_code
+                    ORDER BY props.property_code, slices.category_name,
+                        slices.number_sold DESC, slices.description'''.format(
+                            props=self._properties_sql(in_codes), slices=slices)
+        return self.read(sql, params)
+
+    def cluster_of(self, property_code):
+        sql = 'SELECT MAX(cluster) AS cluster FROM {} WHERE property_code = {}'. \
+            format(self.table, _param('property_code', self.paramstyle))
+        clust = self.read(sql, {'property_code': property_code}).cluster.iloc[0]
+        if pd.isnull(clust):
+            return clust
+        return int(clust) # numpy ints can't be bound as query parameters
+
+    def describe(self, property_code):
+        sql = 'SELECT flag_name, city, state FROM {} WHERE property_code = {} LIMIT 1'. \
+            format(self.table, _param('property_code', self.paramstyle))
+        return self.read(sql, {'property_code': property_code}).iloc[0]
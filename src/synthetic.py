@@ -0,0 +1,105 @@
+import pandas as pd
+import numpy as np
+
+KINDS = ['full_service', 'limited_service', 'extended_stay']
+GUEST_PROFILES = ['business', 'leisure', 'mixed', 'campus']
+LOCATION_TYPES = ['urban', 'suburban', 'airport', 'highway', 'resort']
+STATES = ['TX', 'CA', 'FL', 'NY', 'IL', 'CO', 'GA', 'OH', 'WA', 'ON']
+
+
+def generate_properties(n, n_flags = 60, n_mgmt = None, seed = 0):
+    '''
+    inputs:
+        n = number of properties
+        n_flags = number of hotel flags (brands)
+        n_mgmt = number of management companies, n / 20 by default
+
+    outputs:
+        DataFrame with the columns get_clusters selects for each property
+    '''
+    rng = np.random.RandomState(seed)
+    n_mgmt = n_mgmt or max(1, n // 20)
+    state = rng.choice(STATES, n)
+    canadian = state == 'ON'
+    zips = np.where(canadian, 'M5V 1J1', pd.Series(rng.randint(10000, 99999, n)).astype(str))
+    flag_id = rng.zipf(1.6, n) % n_flags
+    return pd.DataFrame({
+        'property_id': np.arange(n),
+        'property_code': ['P{:06d}'.format(i) for i in range(n)],
+        'property_name': ['Hotel {}'.format(i) for i in range(n)],
+        'address': ['{} Main St'.format(i) for i in range(n)],
+        'city': ['City {}'.format(c) for c in rng.randint(0, max(1, n // 10), n)],
+        'state': state,
+        'zip': zips,
+        'sales_tax_rate': rng.uniform(0.04, 0.1, n).round(4),
+        'alcohol_tax_rate': np.nan,
+        'tobacco_tax_rate': np.nan,
+        'management_company_id': rng.zipf(1.8, n) % n_mgmt,
+        'flag_id': flag_id,
+        'flag_name': ['Flag {}'.format(f) for f in flag_id],
+        'brand_id': flag_id // 5,
+        'brand_name': ['Brand {}'.format(f // 5) for f in flag_id],
+        'kind': rng.choice(KINDS, n, p=[0.3, 0.5, 0.2]),
+        'guest_profile': rng.choice(GUEST_PROFILES, n),
+        'currency_id': np.where(canadian, 2, 1),
+        'location_type': rng.choice(LOCATION_TYPES, n),
+        'rooms': rng.lognormal(4.7, 0.5, n).astype(int) + 20,
+        })
+
+def generate_sales(props, n_months = 24, n_categories = 20, products_per_category = 40,
+                   stocked_per_category = 8, n_clusters = 6, start_month = '2018-01', seed = 0):
+    '''
+    inputs:
+        props = DataFrame from generate_properties
+        n_months = number of transaction months
+        n_categories, products_per_category = size of the catalog
+        stocked_per_category = products each property carries per category
+        n_clusters = clusters to assign the properties to at random
+
+    outputs:
+        DataFrame shaped like product_category_recommender: one row per property x stocked
+        product x month. Product popularity is Zipf-skewed within a category, bigger hotels
+        sell more, and each property prices a product at one of a few price points around
+        its list price
+    '''
+    rng = np.random.RandomState(seed)
+    n_props = props.shape[0]
+    n_products = n_categories * products_per_category
+    months = pd.period_range(start_month, periods=n_months, freq='M').strftime('%Y-%m')
+    list_price = np.round(rng.lognormal(0.9, 0.5, n_products), 2)
+    popularity = 1.0 / np.arange(1, products_per_category + 1) ** 1.1
+
+    # every property stocks stocked_per_category products per category, popular ones more often
+    p = popularity / popularity.sum()
+    stocked = np.concatenate([
+        c * products_per_category + np.argsort(rng.random_sample((n_props, products_per_category)) ** (1 / p),
+                                               axis=1)[:, -stocked_per_category:]
+        for c in range(n_categories)], axis=1)
+    prop_idx = np.repeat(np.arange(n_props), stocked.shape[1])
+    prod_idx = stocked.ravel()
+
+    # a property's price for a product is one of 5 markups on the list price
+    markup = np.array([0.85, 0.95, 1.0, 1.1, 1.25])[rng.randint(0, 5, prod_idx.shape[0])]
+    price = np.round(list_price[prod_idx] * markup, 2)
+    rate = popularity[prod_idx % products_per_category] * (props.rooms.values[prop_idx] / 40.0) * markup ** -1.5
+
+    n_pairs = prod_idx.shape[0]
+    sold = rng.poisson(np.tile(rate, n_months) * rng.gamma(4, 0.25, n_pairs * n_months))
+    pair = np.tile(np.arange(n_pairs), n_months)
+    month = np.repeat(np.arange(n_months), n_pairs)
+    clusters = rng.randint(0, n_clusters, n_props)
+
+    prop_rows = prop_idx[pair]
+    prod_rows = prod_idx[pair]
+    return pd.DataFrame({
+        'property_code': props.property_code.values[prop_rows],
+        'cluster': clusters[prop_rows],
+        'flag_name': props.flag_name.values[prop_rows],
+        'city': props.city.values[prop_rows],
+        'state': props.state.values[prop_rows],
+        'category_name': np.array(['Category {:02d}'.format(c) for c in range(n_categories)])[prod_rows // products_per_category],
+        'description': np.array(['Product {:05d}'.format(i) for i in range(n_products)])[prod_rows],
+        'transaction_month': np.asarray(months)[month],
+        'number_sold': sold,
+        'dollars_sold': np.round(sold * price[pair], 2),
+        })
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules import each other as src.<module>, so the repository root has to be importable
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
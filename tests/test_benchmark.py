@@ -0,0 +1,16 @@
+import pytest
+
+pytest.importorskip('pandas')
+
+from src.benchmark import run_benchmark
+
+STAGES = ['sales_cube_build', 'compare_products', 'prod_subset', 'optimize_prices', 'clustering_birch']
+
+
+def test_run_benchmark_end_to_end():
+    out = run_benchmark(200, n_months=3, n_categories=3, stocked_per_category=4, queries=10, products=5)
+    assert list(out.stage) == STAGES
+    assert (out.seconds >= 0).all()
+    assert (out.peak_mb >= 0).all()
+    assert (out.properties == 200).all()
+    assert (out.sales_rows > 0).all()
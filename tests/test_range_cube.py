@@ -0,0 +1,38 @@
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+from src.range_cube import RangeCube
+
+
+@pytest.fixture
+def sold():
+    rows = [
+        # cluster, property_code, description, transaction_month, number_sold
+        (1, 'AAA', 'Cola', '2019-07', 4),
+        (1, 'AAA', 'Ale', '2019-08', 3),
+        (1, 'AAA', 'Cola', '2019-09', 1),
+        (1, 'BBB', 'Tea', '2019-08', 9),
+        (2, 'CCC', 'Ale', '2019-09', 2),
+        ]
+    df = pd.DataFrame(rows, columns=['cluster', 'property_code', 'description', 'transaction_month', 'number_sold'])
+    df['category_name'] = 'Beverage: Soda'
+    df['flag_name'] = 'Flag'
+    df['city'] = 'Denver'
+    df['state'] = 'CO'
+    return df
+
+@pytest.mark.parametrize('month', ['2019-08', ('2019-07', '2019-08'), ('2019-07', '2019-09')])
+def test_from_frames_matches(sold, month):
+    # what a worker attaches to in shared mode (see src/shared_dataset.py)
+    cube = RangeCube(sold)
+    attached = RangeCube.from_frames(**cube.frames())
+    for property_code in ['AAA', 'BBB', 'ZZZ']:
+        pd.testing.assert_frame_equal(cube.sold_by_store(property_code, 'Beverage: Soda', month),
+                                      attached.sold_by_store(property_code, 'Beverage: Soda', month))
+    for cluster in [1, 2]:
+        pd.testing.assert_frame_equal(cube.top_sold_by_cluster(cluster, 'Beverage: Soda', month, 2),
+                                      attached.top_sold_by_cluster(cluster, 'Beverage: Soda', month, 2))
+    pd.testing.assert_frame_equal(cube.top_sold_overall('Beverage: Soda', month, 3),
+                                  attached.top_sold_overall('Beverage: Soda', month, 3))
+    assert attached.cluster_of('CCC') == 2
@@ -0,0 +1,37 @@
+import sqlite3
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+from src.encoding import SalesDictionary, encode_sales
+from src.sales_cube import SalesCube
+from src.sql_recommender import SqlSales
+
+
+def _sold(rows, month):
+    df = pd.DataFrame(rows, columns=['cluster', 'property_code', 'description', 'number_sold'])
+    df['category_name'] = 'Beverage: Soda'
+    df['transaction_month'] = month
+    df['flag_name'] = 'Flag'
+    df['city'] = 'Denver'
+    df['state'] = 'CO'
+    return df
+
+def test_ties_follow_the_text_after_the_dictionary_grows():
+    dictionary = SalesDictionary()
+    encode_sales(_sold([(1, 'AAA', 'Cola', 3)], '2019-08'), dictionary) # 'Cola' gets the first code
+
+    later = _sold([(1, 'AAA', 'Cola', 5), (1, 'AAA', 'Ale', 5), (1, 'BBB', 'Water', 1)], '2019-09')
+    encoded = encode_sales(later, dictionary)
+    assert list(encoded.description.cat.categories[:2]) == ['Cola', 'Ale'] # appended, not sorted
+
+    conn = sqlite3.connect(':memory:')
+    later.to_sql('product_category_recommender', conn, index=False)
+    sql = SqlSales(read=lambda q, params: pd.read_sql_query(q, conn, params=params), paramstyle='named')
+
+    expected = ['Ale', 'Cola', 'Water']
+    for source in [SalesCube(encoded), SalesCube(later), sql]:
+        assert list(source.top_sold_overall('Beverage: Soda', '2019-09', 3).description.astype(str)) == expected
+        assert list(source.top_sold_by_cluster(1, 'Beverage: Soda', '2019-09', 1).description.astype(str)) == ['Ale']
+        assert list(source.sold_by_store('AAA', 'Beverage: Soda', '2019-09').description.astype(str)) == ['Ale', 'Cola']
+    conn.close()
@@ -0,0 +1,96 @@
+import sqlite3
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+from src.sales_cube import SalesCube
+from src.sql_recommender import SqlSales
+
+MONTH = '2019-09'
+
+
+@pytest.fixture
+def sold():
+    '''
+    two clusters, with ties in number_sold at the store, cluster and national level so
+    the description tie break is exercised, and a second month that must be filtered out
+    '''
+    rows = [
+        # cluster, property_code, description, transaction_month, number_sold
+        (1, 'AAA', 'Cola', MONTH, 5),
+        (1, 'AAA', 'Ale', MONTH, 5),
+        (1, 'AAA', 'Water', MONTH, 2),
+        (1, 'AAA', 'Water', MONTH, 1), # two rows for one product are summed
+        (1, 'AAA', 'Juice', MONTH, 0), # never sold, left out
+        (1, 'BBB', 'Water', MONTH, 4),
+        (1, 'BBB', 'Tea', MONTH, 9),
+        (2, 'CCC', 'Tea', MONTH, 1),
+        (2, 'CCC', 'Cola', MONTH, 7),
+        (2, 'CCC', 'Ale', MONTH, 2),
+        (1, 'AAA', 'Tea', '2019-08', 50),
+        ]
+    df = pd.DataFrame(rows, columns=['cluster', 'property_code', 'description', 'transaction_month', 'number_sold'])
+    df['category_name'] = 'Beverage: Soda'
+    df['flag_name'] = 'Flag'
+    df['city'] = 'Denver'
+    df['state'] = 'CO'
+    df['dollars_sold'] = df.number_sold * 1.5
+    return df
+
+@pytest.fixture
+def sources(sold):
+    conn = sqlite3.connect(':memory:')
+    sold.to_sql('product_category_recommender', conn, index=False)
+    read = lambda sql, params: pd.read_sql_query(sql, conn, params=params)
+    yield SalesCube(sold), SqlSales(read=read, paramstyle='named')
+    conn.close()
+
+def _same(expected, actual):
+    pd.testing.assert_frame_equal(expected.reset_index(drop=True), actual.reset_index(drop=True),
+                                  check_dtype=False)
+
+@pytest.mark.parametrize('property_code', ['AAA', 'BBB', 'CCC', 'ZZZ'])
+def test_sold_by_store(sources, property_code):
+    cube, sql = sources
+    _same(cube.sold_by_store(property_code, 'Beverage: Soda', MONTH),
+          sql.sold_by_store(property_code, 'Beverage: Soda', MONTH))
+
+@pytest.mark.parametrize('num', [1, 2, 5])
+def test_top_sold_by_cluster(sources, num):
+    cube, sql = sources
+    for cluster in [1, 2]:
+        _same(cube.top_sold_by_cluster(cluster, 'Beverage: Soda', MONTH, num),
+              sql.top_sold_by_cluster(cluster, 'Beverage: Soda', MONTH, num))
+
+@pytest.mark.parametrize('num', [1, 2, 5])
+def test_top_sold_overall(sources, num):
+    cube, sql = sources
+    _same(cube.top_sold_overall('Beverage: Soda', MONTH, num),
+          sql.top_sold_overall('Beverage: Soda', MONTH, num))
+
+def test_number_sold_is_integer(sources):
+    cube, sql = sources
+    assert pd.api.types.is_integer_dtype(sql.top_sold_overall('Beverage: Soda', MONTH, 5).number_sold)
+
+def test_cluster_and_describe(sources):
+    cube, sql = sources
+    assert sql.cluster_of('CCC') == cube.cluster_of('CCC')
+    assert list(sql.describe('AAA')) == list(cube.describe('AAA'))
+
+@pytest.mark.parametrize('peers', [['AAA', 'BBB'], ['AAA', 'CCC', 'ZZZ'], ['CCC']])
+def test_top_sold_by_properties(sources, peers):
+    from src.category_recommender import top_sold_by_peers
+    cube, sql = sources
+    _same(top_sold_by_peers(peers, 'Beverage: Soda', MONTH, 3, cube),
+          sql.top_sold_by_properties(peers, 'Beverage: Soda', MONTH, 3))
+
+def test_recommend_many(sources):
+    from src.category_recommender import recommend, recommend_many
+    cube, sql = sources
+    pairs = [('AAA', 'Beverage: Soda'), ('CCC', 'Beverage: Soda'), ('ZZZ', 'Beverage: Soda'),
+             ('BBB', 'Snacks')]
+    expected = recommend_many(pairs, MONTH, 2, cube)
+    assert recommend_many(pairs, MONTH, 2, sql) == expected
+    assert expected[0] == recommend('AAA', 'Beverage: Soda', MONTH, 2, cube)
+    assert expected[2]['error'] == 'unknown property_code'
+    assert not expected[3]['sold_in_category']